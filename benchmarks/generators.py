@@ -0,0 +1,135 @@
+"""
+Synthetic inputs for the benchmarks, so that no simulation data is needed
+"""
+import os
+import numpy as np
+
+def make_mbii(path, simulation, N, fsat=0.3, seed=42):
+    """
+    Write MBII-style ``_cenHaloID``, ``_satHaloID`` and ``_mass`` binary
+    files for ``N`` galaxies, a fraction ``fsat`` of which are satellites
+    
+    Each central lives in its own halo, and satellites are assigned to
+    random halos, some of which host no central
+    """
+    rng = np.random.RandomState(seed)
+    Nsat = int(N * fsat)
+    Ncen = N - Nsat
+    
+    # halo ids, with gaps so that ids are not simply the index
+    halos = np.sort(rng.choice(4*N, size=Ncen + Nsat//10 + 1, replace=False)).astype('i8')
+    haloid_cen = halos[:Ncen]
+    haloid_sat = rng.choice(halos, size=Nsat).astype('i8')
+    
+    # masses, in Msun/h
+    mass_cen = 10**rng.uniform(9., 14., size=Ncen)
+    mass_sat = 10**rng.uniform(9., 13., size=Nsat)
+    
+    for subdir, haloids, mass, name in [('Centrals', haloid_cen, mass_cen, 'cen'),
+                                        ('Satellites', haloid_sat, mass_sat, 'sat')]:
+        dirname = os.path.join(path, subdir)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        haloids.tofile(os.path.join(dirname, '%s_%sHaloID' %(simulation, name)))
+        mass.astype('f8').tofile(os.path.join(dirname, '%s_mass' %simulation))
+
+def _write_metadata(ff, meta, prefix=''):
+    ff.write("%smetadata %d\n" %(prefix, len(meta)))
+    for key in sorted(meta):
+        val = meta[key]
+        ff.write("%s%s %r %s\n" %(prefix, key, val, type(val).__name__))
+
+def write_power_1d(filename, k, power, modes, edges, meta={}):
+    """
+    Write a 1D power spectrum in the nbodykit plain text format
+    """
+    with open(filename, 'w') as ff:
+        ff.write("# k power.real power.imag modes\n")
+        np.savetxt(ff, np.vstack([k, power.real, power.imag, modes]).T, fmt='%.8e')
+        ff.write("#edges %d\n" %len(edges))
+        for e in edges:
+            ff.write("#%.8e\n" %e)
+        _write_metadata(ff, meta, prefix='#')
+
+def write_power_2d(filename, k, mu, power, modes, edges, meta={}):
+    """
+    Write a 2D power spectrum in the nbodykit plain text format
+    """
+    Nk, Nmu = k.shape
+    with open(filename, 'w') as ff:
+        ff.write("%d %d\n" %(Nk, Nmu))
+        ff.write("k mu power.real power.imag modes\n")
+        cols = [k.ravel(), mu.ravel(), power.real.ravel(), power.imag.ravel(), modes.ravel()]
+        np.savetxt(ff, np.vstack(cols).T, fmt='%.8e')
+        for e in edges:
+            ff.write("edges %d\n" %len(e))
+            np.savetxt(ff, e, fmt='%.8e')
+        _write_metadata(ff, meta)
+
+def make_power_files(dirname, mode, Nfiles, Nk=100, Nmu=5, seed=42):
+    """
+    Write ``Nfiles`` noisy realizations of a power spectrum in the 1D or
+    2D nbodykit plain text format, and return the glob pattern matching them
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    rng = np.random.RandomState(seed)
+    
+    kedges = np.linspace(0.005, 0.5, Nk+1)
+    muedges = np.linspace(0., 1., Nmu+1)
+    kcen = 0.5*(kedges[1:] + kedges[:-1])
+    mucen = 0.5*(muedges[1:] + muedges[:-1])
+    
+    for i in range(Nfiles):
+        meta = {'N1':int(rng.randint(10**5, 10**6)), 'Lx':1000., 'volume':1e9}
+        if mode == '1d':
+            modes = np.floor(4*np.pi*kcen**2 * 1e4)
+            power = 1e4/(1 + (kcen/0.05)**2) * (1 + rng.randn(Nk)/np.sqrt(modes)) + 0j
+            write_power_1d(os.path.join(dirname, 'pk_%04d.dat' %i), kcen, power, modes, kedges, meta)
+        else:
+            k, mu = np.meshgrid(kcen, mucen, indexing='ij')
+            modes = np.floor(4*np.pi*k**2 * 1e4 / Nmu)
+            power = 1e4*(1 + mu**2)**2/(1 + (k/0.05)**2) * (1 + rng.randn(Nk, Nmu)/np.sqrt(modes)) + 0j
+            write_power_2d(os.path.join(dirname, 'pkmu_%04d.dat' %i), k, mu, power, modes, [kedges, muedges], meta)
+    
+    return os.path.join(dirname, 'pk_*.dat' if mode == '1d' else 'pkmu_*.dat')
+
+def random_mesh(Nmesh, dtype='c8', seed=42):
+    """
+    A random complex mesh, with the shape of the real-to-complex FFT of
+    an ``Nmesh**3`` real mesh
+    """
+    rng = np.random.RandomState(seed)
+    shape = (Nmesh, Nmesh, Nmesh//2 + 1)
+    toret = np.empty(shape, dtype=dtype)
+    toret.real = rng.randn(*shape)
+    toret.imag = rng.randn(*shape)
+    return toret
+
+def mesh_wavenumbers(Nmesh, BoxSize=1000.):
+    """
+    The wavenumbers of the complex mesh, as the broadcastable list
+    stored as ``ParticleMesh.k``
+    """
+    kf = 2*np.pi / BoxSize
+    k = [np.fft.fftfreq(Nmesh, 1./Nmesh)*kf, np.fft.fftfreq(Nmesh, 1./Nmesh)*kf, np.arange(Nmesh//2+1)*kf]
+    return [k[0][:,None,None], k[1][None,:,None], k[2][None,None,:]]
+
+def make_iterpower_grid(Ndims, Nvals):
+    """
+    A template config, selection parameters and sample grid of ``Nvals**Ndims``
+    samples, in the form used by ``iterpower.submit_jobs``
+    """
+    dims = ['dim%d' %i for i in range(Ndims)]
+    coords = [['%d' %j for j in range(Nvals)] for i in range(Ndims)]
+    
+    lines = ["mode: 1d", "Nmesh: 256", "output: pk_" + "_".join('{%s}' %d for d in dims) + ".dat"]
+    lines += ["%s: {%s}" %(d, d) for d in dims]
+    lines += ["field:", "    DataSource:", "        plugin: FastPM", "        path: {path}"]
+    config = "\n".join(lines) + "\n"
+    
+    select = {}
+    for dim, vals in zip(dims, coords):
+        for val in vals:
+            select['%s_%s' %(dim, val)] = {dim: 'value_%s' %val}
+    return config, select, dims, coords
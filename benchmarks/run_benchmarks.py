@@ -0,0 +1,276 @@
+"""
+Time and record the peak memory of the nbkit_addons tools on synthetic
+inputs, across scales, and append the results to a JSON history
+
+Each case is run in a fresh subprocess, so that the peak memory of one
+case does not leak into the next
+"""
+import argparse as ap
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import numpy as np
+
+import generators
+
+# the directory holding the tools and transfers
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+sys.path.insert(0, os.path.join(ROOT, 'transfer'))
+from profiling import peak_rss
+
+# the sizes of each case
+SCALES = {}
+SCALES['add_halo_sizes'] = {'small':10**5, 'medium':10**6, 'large':10**7}
+SCALES['average'] = {'small':20, 'medium':200, 'large':2000}
+SCALES['average_from_files'] = {'small':20, 'medium':200, 'large':2000}
+SCALES['iterpower_render'] = {'small':(2, 5), 'medium':(2, 20), 'large':(3, 10)}
+SCALES['momentum_transfers'] = {'small':64, 'medium':128, 'large':256}
+SCALES['fused_transfers'] = SCALES['momentum_transfers']
+SCALES['fused_transfers_blocked'] = SCALES['momentum_transfers']
+
+#------------------------------------------------------------------------------
+# setup of the inputs, run once per case and scale in the parent process
+#------------------------------------------------------------------------------
+def setup_mbii(workdir, N):
+    generators.make_mbii(workdir, 'bench', N)
+
+def setup_power(workdir, N):
+    generators.make_power_files(os.path.join(workdir, 'power'), '1d', N)
+
+SETUP = {'add_halo_sizes':setup_mbii, 'average':setup_power, 'average_from_files':setup_power}
+
+#------------------------------------------------------------------------------
+# the cases, run in a subprocess; each returns the function to time
+#------------------------------------------------------------------------------
+def case_add_halo_sizes(workdir, N):
+    from mbii import galaxy_types, add_halo_sizes, haloid_files
+    
+    cen_file, sat_file = haloid_files(workdir, 'bench')
+    haloid_cen = np.fromfile(cen_file, dtype='i8')
+    haloid_sat = np.fromfile(sat_file, dtype='i8')
+    haloids = np.concatenate([haloid_cen, haloid_sat])
+    types = galaxy_types(len(haloid_cen), len(haloid_sat))
+    return lambda: add_halo_sizes(haloids, types)
+
+def case_average(workdir, N):
+    from glob import glob
+    from nbodykit import dataset
+    from mean_from_files import read_dataset, average
+    
+    pattern = os.path.join(workdir, 'power', 'pk_*.dat')
+    datasets = [read_dataset(f, dataset.Power1dDataSet, '1d') for f in sorted(glob(pattern))]
+    return lambda: average(datasets, weights='modes', sum_only=['modes'])
+
+def case_average_from_files(workdir, N):
+    from mean_from_files import average_from_files
+    
+    args = ap.Namespace(mode='1d', pattern=os.path.join(workdir, 'power', 'pk_*.dat'),
+                        output=os.path.join(workdir, 'pk_mean.dat'), batch=None, weights='modes',
+                        sum_only=['modes'], cls='Power1dDataSet', stats=[], state=None, nprocs=1,
+                        use_mpi=False, cache_dir=None, cache_size=None, no_cache=True)
+    return lambda: average_from_files(args)
+
+def case_iterpower_render(workdir, scale):
+    import itertools
+    import string
+    from iterpower import render_config
+    
+    config, select, dims, coords = generators.make_iterpower_grid(*scale)
+    formatter = string.Formatter()
+    def run():
+        for sample in itertools.product(*coords):
+            render_config(formatter, config, select, dims, sample)
+    return run
+
+class GaussianSmoothing(object):
+    """
+    A k-dependent, element-wise transfer, smoothing on the scale `R`
+    """
+    elementwise = True
+    
+    def __init__(self, R=10.):
+        self.R = R
+        
+    def __call__(self, pm, complex):
+        k2 = sum(k**2 for k in pm.k)
+        complex[:] *= np.exp(-0.5 * k2 * self.R**2)
+
+def _momentum_transfers(Nmesh, fused, blocksize=None):
+    from MomentumMoments import MomentumMomentsAuto, MomentumMomentsCross, FusedTransfer
+    
+    class Mesh(object):
+        k = generators.mesh_wavenumbers(Nmesh)
+    
+    pm = Mesh()
+    mesh = generators.random_mesh(Nmesh)
+    work = np.empty_like(mesh)
+    transfers = [MomentumMomentsAuto(2), GaussianSmoothing(), MomentumMomentsCross(1, 3), MomentumMomentsCross(2, 2)]
+    if fused:
+        # the fused sweep must match applying the transfers one at a time
+        expected = mesh.copy()
+        for t in transfers:
+            t(pm, expected)
+        transfers = [FusedTransfer(transfers, blocksize=blocksize)]
+        work[...] = mesh
+        transfers[0](pm, work)
+        if not (work == expected).all():
+            raise ValueError("the fused transfers do not match their sequential application")
+        
+    def run():
+        # start from the same mesh each time, to avoid denormals
+        work[...] = mesh
+        for t in transfers:
+            t(pm, work)
+    return run
+
+def case_momentum_transfers(workdir, Nmesh):
+    return _momentum_transfers(Nmesh, fused=False)
+
+def case_fused_transfers(workdir, Nmesh):
+    return _momentum_transfers(Nmesh, fused=True)
+
+def case_fused_transfers_blocked(workdir, Nmesh):
+    return _momentum_transfers(Nmesh, fused=True, blocksize=4)
+
+CASES = {'add_halo_sizes':case_add_halo_sizes, 'average':case_average,
+         'average_from_files':case_average_from_files, 'iterpower_render':case_iterpower_render,
+         'momentum_transfers':case_momentum_transfers, 'fused_transfers':case_fused_transfers,
+         'fused_transfers_blocked':case_fused_transfers_blocked}
+
+#------------------------------------------------------------------------------
+# running
+#------------------------------------------------------------------------------
+def run_case(name, scale, workdir, repeat):
+    """
+    Run a single case in this process and return its timings
+    """
+    fn = CASES[name](workdir, SCALES[name][scale])
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return {'time_min':min(times), 'time_median':float(np.median(times)), 'peak_rss':peak_rss()}
+
+def run_subprocess(name, scale, workdir, repeat):
+    """
+    Run a single case in a fresh subprocess, returning its result
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--run_case', name, scale,
+            '--workdir', workdir, '--repeat', str(repeat)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    lines = out.strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return {'status':'error', 'error':err.strip().splitlines()[-1] if err.strip() else 'no output'}
+
+def git_version():
+    """
+    The current git commit of the repository, or `None`
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            cmd = ['git', '-C', ROOT, 'describe', '--always', '--dirty']
+            return subprocess.check_output(cmd, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_history(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as ff:
+        return json.load(ff)
+
+def compare(previous, run):
+    """
+    Print the change in time and memory of each result, relative to
+    the ``previous`` run
+    """
+    old = dict(((r['case'], r['scale']), r) for r in previous['results'] if r['status'] == 'ok')
+    print "\nrelative to %s (%s):" %(previous['version'], previous['date'])
+    for r in run['results']:
+        key = (r['case'], r['scale'])
+        if r['status'] != 'ok' or key not in old:
+            continue
+        dt = r['time_min'] / old[key]['time_min'] if old[key]['time_min'] > 0 else np.nan
+        dm = r['peak_rss'] / old[key]['peak_rss'] if old[key]['peak_rss'] > 0 else np.nan
+        print "%-24s %-7s time x%.2f, peak RSS x%.2f" %(r['case'], r['scale'], dt, dm)
+
+def main(ns):
+    
+    cases = ns.cases if ns.cases else sorted(CASES)
+    workdir = ns.workdir or tempfile.mkdtemp(prefix='nbkit_bench_')
+    
+    run = {'version':git_version(), 'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+           'python':sys.version.split()[0], 'numpy':np.__version__, 'results':[]}
+    
+    print "%-24s %-7s %12s %12s %12s" %('case', 'scale', 'min [s]', 'median [s]', 'peak [MB]')
+    for name in cases:
+        for scale in ns.scales:
+            
+            # generate the inputs
+            casedir = os.path.join(workdir, '%s_%s' %(name, scale))
+            if not os.path.isdir(casedir):
+                os.makedirs(casedir)
+                if name in SETUP:
+                    SETUP[name](casedir, SCALES[name][scale])
+            
+            result = run_subprocess(name, scale, casedir, ns.repeat)
+            result.update({'case':name, 'scale':scale, 'size':SCALES[name][scale]})
+            run['results'].append(result)
+            
+            if result['status'] == 'ok':
+                args = (name, scale, result['time_min'], result['time_median'], result['peak_rss'])
+                print "%-24s %-7s %12.4f %12.4f %12.1f" %args
+            else:
+                print "%-24s %-7s failed: %s" %(name, scale, result['error'])
+    
+    # append to the history
+    history = load_history(ns.history)
+    if len(history):
+        compare(history[-1], run)
+    history.append(run)
+    with open(ns.history, 'w') as ff:
+        json.dump(history, ff, indent=2)
+    print "\nappended results to `%s`" %ns.history
+
+if __name__ == '__main__':
+    
+    desc = "run the nbkit_addons benchmarks on synthetic data, recording the time " + \
+           "and peak memory of each case, and append the results to a JSON history"
+    parser = ap.ArgumentParser(description=desc,
+                                formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    
+    h = 'the cases to run; default is all of them'
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), help=h)
+    h = 'the scales to run each case at'
+    parser.add_argument('--scales', nargs='+', choices=['small', 'medium', 'large'],
+                            default=['small', 'medium'], help=h)
+    h = 'the number of times to run each case'
+    parser.add_argument('--repeat', type=int, default=3, help=h)
+    h = 'the directory for the synthetic inputs; default is a new temporary directory'
+    parser.add_argument('--workdir', type=str, help=h)
+    h = 'the JSON file holding the history of benchmark runs'
+    parser.add_argument('--history', type=str, default=os.path.join(os.path.dirname(__file__), 'history.json'), help=h)
+    
+    # run a single case; used internally
+    parser.add_argument('--run_case', nargs=2, help=ap.SUPPRESS)
+    
+    ns = parser.parse_args()
+    if ns.run_case is not None:
+        try:
+            result = run_case(ns.run_case[0], ns.run_case[1], ns.workdir, ns.repeat)
+            result['status'] = 'ok'
+        except Exception as e:
+            traceback.print_exc()
+            result = {'status':'error', 'error':"%s: %s" %(type(e).__name__, str(e))}
+        print json.dumps(result)
+    else:
+        main(ns)
@@ -1,14 +1,24 @@
 #! /usr/bin/env python
 
 import argparse
+import csv
+import json
 import logging
-import sys
+import os
+import threading
+import time
 import yaml
+import numpy as np
+from glob import glob
 
 from mpi4py import MPI
 
+from nbodykit import dataset
 from nbodykit.extensionpoints import algorithms, Algorithm, DataSource
 from nbodykit.utils.taskmanager import TaskManager
+from online_stats import OnlineMoments, DataSetAccumulator
+from fileio import atomic_write, write_npz, read_npz, write_packed, split_member, read_member, pack_metadata
+from profiling import peak_rss, add_profile_arguments, from_args
 
 # setup the logging
 comm = MPI.COMM_WORLD
@@ -20,62 +30,559 @@ logging.basicConfig(level=logging.INFO,
                     datefmt='%m-%d %H:%M')
 
 
-class BianchiWrapper(object):
+def find_files(params):
+    """
+    Return the existing files named by any of the string values
+    (including glob patterns) in the nested ``params``
+    
+    Matched directories, i.e., the ``BigFile`` catalogs written by
+    nbodykit and FastPM, contribute all of the files below them
+    """
+    toret = []
+    if isinstance(params, dict):
+        for v in params.values():
+            toret += find_files(v)
+    elif isinstance(params, (list, tuple)):
+        for v in params:
+            toret += find_files(v)
+    elif isinstance(params, basestring):
+        for f in glob(params):
+            if os.path.isfile(f):
+                toret.append(f)
+            elif os.path.isdir(f):
+                for root, dirs, files in os.walk(f):
+                    dirs.sort()
+                    toret += [os.path.join(root, ff) for ff in sorted(files)]
+    return toret
+    
+    
+class Prefetcher(object):
+    """
+    Read input files in a background thread, so that they are already in
+    the page cache when the ``DataSource`` of the next box reads them
+    
+    Only plain file reads happen in the background thread; each rank of
+    a worker reads its share of the bytes of each file, roughly the
+    part it reads itself when loading the data
+    """
+    def __init__(self, blocksize=4*1024**2):
+        self.blocksize = blocksize
+        self.thread = None
+        
+    def start(self, filenames, rank=0, size=1):
+        """
+        Start reading ``filenames`` in the background
+        """
+        self.join()
+        self.thread = threading.Thread(target=self._read, args=(filenames, rank, size))
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def join(self):
+        """
+        Wait for any background reads to finish
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+    
+    def _read(self, filenames, rank, size):
+        for f in filenames:
+            try:
+                nbytes = os.path.getsize(f)
+                start, stop = nbytes*rank//size, nbytes*(rank+1)//size
+                with open(f, 'rb') as ff:
+                    ff.seek(start)
+                    while start < stop:
+                        chunk = ff.read(min(self.blocksize, stop-start))
+                        if not chunk: break
+                        start += len(chunk)
+            except (IOError, OSError):
+                pass
+    
+
+def result_arrays(names, result):
+    """
+    Return the ``(data, metadata)`` of a ``BianchiFFTPower`` result, in
+    the form returned by the nbodykit plain text readers
+    
+    Parameters
+    ----------
+    names : list of str
+        the names of the columns of the multipoles
+    result : tuple
+        the ``(edges, poles, meta)`` returned by ``BianchiFFTPower.run``
+    """
+    edges, poles, meta = result
+    if getattr(getattr(poles, 'dtype', None), 'names', None) is not None:
+        data = np.asarray(poles)
+    else:
+        poles = [np.asarray(p) for p in poles]
+        data = np.empty(poles[0].shape, dtype=[(name, p.dtype) for name, p in zip(names, poles)])
+        for name, p in zip(names, poles):
+            data[name] = p
+            
+    meta = dict(meta)
+    meta['edges'] = np.asarray(edges)
+    return data, meta
+    
+def save_result(filename, data, meta):
+    """
+    Atomically write the binary result ``(data, meta)`` to ``filename``, 
+    as a ``.npz`` file (without adding the extension)
+    """
+    with atomic_write(filename) as ff:
+        write_npz(ff, data, meta)
+        
+def load_result(source):
+    """
+    Return the ``(data, metadata)`` of a result saved with ``--output_format npz``,
+    or of a member of an archive written with ``--pack``, given as ``archive::member``
+    
+    Archive members are memory mapped, rather than read into memory
+    """
+    if split_member(source)[1] is not None:
+        return read_member(source)
+    return read_npz(source)
+    
+# the timed stages of each box
+STAGES = ['config', 'datasource', 'run', 'save']
+
+def summarize_profile(records):
+    """
+    Return the minimum, median and maximum of each stage (and the peak
+    RSS) over all of the per-box, per-rank ``records``
+    """
+    toret = {}
+    for key in STAGES + ['total', 'peak_rss']:
+        values = np.array([r[key] for r in records])
+        if not len(values): continue
+        toret[key] = {'min':values.min(), 'median':np.median(values), 'max':values.max()}
+    return toret
+    
+def write_profile(filename, records):
+    """
+    Write the per-box, per-rank timing ``records`` and their summary
+    to ``filename``, as CSV
+    """
+    summary = summarize_profile(records)
+    columns = ['box', 'template', 'rank', 'worker_rank'] + STAGES + ['total', 'peak_rss']
+    
+    with open(filename, 'w') as ff:
+        writer = csv.writer(ff)
+        writer.writerow(columns)
+        for r in sorted(records, key=lambda r: (r['box'], r['template'], r['rank'])):
+            writer.writerow([r[c] for c in columns])
+            
+        # the summary rows, labeled in the ``box`` column
+        for stat in ['min', 'median', 'max']:
+            row = [stat, '', '', ''] + [summary[c][stat] if c in summary else '' for c in columns[4:]]
+            writer.writerow(row)
+    
+
+class Journal(object):
+    """
+    A journal of finished boxes, stored as one JSON record per line, 
+    holding the output file, its size and the time taken for each box
+    and config template
+    
+    Records are appended as soon as each box is saved, so the journal
+    survives a job that dies part way through a batch
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as ff:
+                for line in ff:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # partially written line
+                    self.entries[entry['output']] = entry
+                    
+    def record(self, box, output, elapsed):
+        """
+        Record that ``box`` was saved to ``output``, taking ``elapsed`` seconds
+        """
+        entry = {'box':box, 'output':output, 'size':os.path.getsize(output), 'time':elapsed}
+        with open(self.filename, 'a') as ff:
+            ff.write(json.dumps(entry) + "\n")
+        self.entries[output] = entry
+        
+    def is_complete(self, box, output):
+        """
+        Whether ``box`` has been saved to ``output``, and the file
+        still has the size it had when it was recorded
+        """
+        entry = self.entries.get(output, None)
+        if entry is None or entry['box'] != box:
+            return False
+        return os.path.exists(output) and os.path.getsize(output) == entry['size']
+        
+    def timing(self, box):
+        """
+        The total recorded time taken for ``box``, or `None`
+        """
+        times = [e['time'] for e in self.entries.values() if e['box'] == box]
+        return sum(times) if len(times) else None
+        
+    def schedule(self, boxes, outputs, force=False):
+        """
+        Return the boxes that still need to be computed, ordered from the
+        longest to the shortest recorded time
+        
+        Boxes without a recorded time are assumed to take the median time
+        
+        Parameters
+        ----------
+        boxes : list of int
+            the box numbers
+        outputs : list of str
+            the output file patterns of each template, with a ``box`` keyword;
+            a box is complete only if all of the outputs are
+        force : bool, optional
+            if `True`, do not skip completed boxes
+        """
+        complete = lambda box: all(self.is_complete(box, output.format(box=box)) for output in outputs)
+        todo = [box for box in boxes if force or not complete(box)]
+        
+        timings = dict((box, self.timing(box)) for box in todo)
+        times = sorted(t for t in timings.values() if t is not None)
+        median = times[len(times)//2] if len(times) else 0.
+        timing = lambda box: timings[box] if timings[box] is not None else median
+        return sorted(todo, key=timing, reverse=True)
+    
 
-    def __init__(self, template):
+class EnsembleReducer(object):
+    """
+    A running mean, and optionally the covariance, of the 
+    ``BianchiFFTPower`` results, accumulated in memory one box at a time
+    
+    The mean is computed by the `DataSetAccumulator` of ``mean_from_files.py``,
+    with the same rules: the ``sum_only`` columns are summed, the others
+    are weighted by the ``weights`` column, and the numeric metadata 
+    is averaged, so the reduction matches averaging the saved results
+    
+    Parameters
+    ----------
+    weights : str, optional
+        the name of the column to weight the mean by; if `None`, use 
+        uniform weights
+    sum_only : list of str, optional
+        the columns which are summed over, not averaged
+    covariance : bool, optional
+        if `True`, also track the covariance of the multipoles across boxes
+    """
+    def __init__(self, weights='modes', sum_only=['modes'], covariance=False):
+        self.accumulator = DataSetAccumulator(weights=weights, sum_only=sum_only)
+        self.moments = OnlineMoments() if covariance else None
+        self.boxes = []
+        self.edges = None
+        
+    def __len__(self):
+        return len(self.boxes)
         
-        with open(template, 'r') as ff:
-            self.config = ff.read()
+    def update(self, box, data, meta):
+        """
+        Add the result of a single box
+        
+        Parameters
+        ----------
+        box : int
+            the box number
+        data, meta : 
+            the result of the box, as returned by `result_arrays`
+        """
+        d = dataset.Power1dDataSet.from_nbkit(data, meta, sum_only=self.accumulator.sum_only, 
+                                                force_index_match=True)
+        self.accumulator.update(d)
+        if self.edges is None:
+            self.edges = np.array(meta['edges'], copy=True)
             
-            raw_config = yaml.load(self.config)
-            self.data_params = raw_config['data']
-            self.output = raw_config['output']
+        if self.moments is not None:
+            self.moments.update([data[name] for name in data.dtype.names if name.startswith('power_')])
+        self.boxes.append(box)
+        
+    def merge(self, other):
+        """
+        Merge the partial results of another reducer into this one
+        """
+        self.accumulator.merge(other.accumulator)
+        if self.edges is None and other.edges is not None:
+            self.edges = other.edges.copy()
+        if self.moments is not None:
+            self.moments.merge(other.moments)
+        self.boxes += other.boxes
+        return self
+        
+    def save(self, filename):
+        """
+        Save the mean of each column, the bin edges, the metadata and, if 
+        tracked, the statistics of the multipoles across boxes to a ``.npz`` file
+        """
+        if not len(self):
+            raise ValueError("cannot save the reduction of zero boxes")
             
-        self.algorithm = None
+        mean = self.accumulator.result()
+        toret = {'edges':self.edges, 'boxes':np.array(sorted(self.boxes)), 
+                 'weight_sum':self.accumulator.weight_sum}
+        for name in mean.variables:
+            toret[name] = mean[name]
+        attrs = dict((k, v) for k, v in mean.attrs.items() if k != 'edges')
+        toret.update(pack_metadata(attrs))
+        if self.moments is not None:
+            toret.update(self.moments.to_dict(prefix='power_'))
+        np.savez(filename, **toret)
+    
 
-    def __call__(self, i, box):
+class BianchiWrapper(object):
+    """
+    Run ``BianchiFFTPower`` on each box, for one or more config templates
+    
+    All of the templates are run on a box before moving to the next one,
+    and templates with identical ``data`` (or ``randoms``) sections share
+    a single ``DataSource``, so that the catalogs, and the cache kept by
+    ``keep_cache``, are only loaded once
+    
+    With ``prefetch``, each task is the list of boxes of a worker, which 
+    are run in order, reading the input files of the next box in the
+    background while the current one is processed
+    """
+    def __init__(self, templates, prefetch=False, journal=None, profile=False,
+                    reducers=None, save=True, output_format='plaintext'):
         
-        # have to create the algorithm
-        if self.algorithm is None:
+        if isinstance(templates, basestring):
+            templates = [templates]
+        
+        self.configs = []; self.outputs = []
+        for template in templates:
+            with open(template, 'r') as ff:
+                config = ff.read()
+                
+                raw_config = yaml.load(config)
+                self.configs.append(config)
+                self.outputs.append(raw_config['output'])
+        
+        if len(set(self.outputs)) != len(self.outputs):
+            raise ValueError("each config template must have a different ``output``")
+        
+        self.algorithms = [None]*len(self.configs)
+        self.journal = journal
+        
+        # the randoms, shared by all templates with the same ``randoms``
+        self.randoms = {}
+        
+        # the per-box timing records of this rank
+        self.timings = [] if profile else None
+        
+        # the in-memory reduction of the results, one per template
+        self.reducers = reducers
+        self.save = save
+        self.output_format = output_format
+        
+        # read the next box of this worker in the background
+        self.prefetcher = Prefetcher() if prefetch else None
+        self.next_box = None
+    
+    @property
+    def comm(self):
+        """
+        The communicator of this worker
+        """
+        return getattr(self.algorithms[0], 'comm', None)
+    
+    def prefetch(self, box):
+        """
+        Start reading the input files of ``box``
+        """
+        filenames = []
+        for config in self.configs:
+            data = yaml.load(config.format(box=box))['data']
+            filenames += [f for f in find_files(data) if f not in filenames]
+        rank, size = (self.comm.rank, self.comm.size) if self.comm is not None else (0, 1)
+        self.prefetcher.start(filenames, rank, size)
+    
+    def column_names(self, j, poles):
+        """
+        The names of the columns of the multipoles result of template ``j``
+        """
+        names = getattr(getattr(poles, 'dtype', None), 'names', None)
+        if names is not None:
+            return list(names)
+        return ['k'] + ['power_%d' %ell for ell in self.algorithms[j].ells] + ['modes']
+    
+    def __call__(self, i, boxes):
+        
+        # a single box, or the boxes of this worker, in order
+        if not isinstance(boxes, list):
+            boxes = [boxes]
+        
+        for k, box in enumerate(boxes):
+            self.next_box = boxes[k+1] if k+1 < len(boxes) else None
             
-            # update the config file replace `box` keyword
-            config = self.config.format(box=box)
+            # the ``data`` DataSources of this box, keyed by their config section
+            sources = {}
+            for j in range(len(self.configs)):
+                self.compute(j, box, sources)
+    
+    def compute(self, j, box, sources):
+        """
+        Run template ``j`` on ``box``, sharing the DataSources in ``sources``
+        """
+        start = time.time()
+        times = [start]
+        
+        # update the config file replace `box` keyword
+        config = self.configs[j].format(box=box)
+        kws = yaml.load(config)
+        key = yaml.dump(kws['data'])
+        
+        # have to create the algorithm
+        if self.algorithms[j] is None:
             
             # parse the config file
             params, extra = Algorithm.parse_known_yaml('BianchiFFTPower', config)
+            times.append(time.time())
             
             # initialize the algorithm
-            self.algorithm = algorithms.BianchiFFTPower(**vars(params))
-            self.algorithm.keep_cache = True # keep the cache
+            algorithm = self.algorithms[j] = algorithms.BianchiFFTPower(**vars(params))
+            algorithm.keep_cache = True # keep the cache
             
+            # share the randoms and the data with the other templates
+            rkey = yaml.dump(kws.get('randoms', None))
+            algorithm.catalog.randoms = self.randoms.setdefault(rkey, algorithm.catalog.randoms)
+            algorithm.catalog.data = sources.setdefault(key, algorithm.catalog.data)
+        
         else:
+            times.append(time.time())
             
-            # create a new ``data`` DataSource and set it
-            config = self.config.format(box=box)
-            kws = yaml.load(config)['data']
-            data = DataSource.from_config(kws)
-            self.algorithm.catalog.data = data
-            
-        result = self.algorithm.run()    
-        output = self.output.format(box=box)
-        self.algorithm.save(output, result)
-            
+            # create a new ``data`` DataSource, unless another template made it
+            if key not in sources:
+                sources[key] = DataSource.from_config(kws['data'])
+            algorithm = self.algorithms[j]
+            algorithm.catalog.data = sources[key]
+        times.append(time.time())
+        
+        # overlap reading the next box with this one
+        if self.prefetcher is not None and j == 0 and self.next_box is not None:
+            self.prefetch(self.next_box)
+        
+        result = algorithm.run()
+        times.append(time.time())
+        
+        # add to the reduction on the root of this worker
+        if self.reducers is not None and algorithm.comm.rank == 0:
+            names = self.column_names(j, result[1])
+            self.reducers[j].update(box, *result_arrays(names, result))
+        
+        output = self.outputs[j].format(box=box)
+        if self.save:
+            if self.output_format == 'npz':
+                if algorithm.comm.rank == 0:
+                    names = self.column_names(j, result[1])
+                    save_result(output, *result_arrays(names, result))
+            else:
+                algorithm.save(output, result)
+        times.append(time.time())
+        
+        # record the finished box
+        if self.save and self.journal is not None and algorithm.comm.rank == 0:
+            self.journal.record(box, output, time.time()-start)
+        
+        # record the time spent in each stage
+        if self.timings is not None:
+            record = {'box':box, 'template':j, 'rank':rank, 'worker_rank':algorithm.comm.rank}
+            for i, stage in enumerate(STAGES):
+                record[stage] = times[i+1] - times[i]
+            record['total'] = times[-1] - start
+            record['peak_rss'] = peak_rss()
+            self.timings.append(record)
 
-def main(ns):
 
+def main(ns):
+    
+    # the stages of all ranks go to a JSON file, alongside a CSV of the boxes
+    filename = ns.profile
+    if ns.profile is not None and ns.profile.endswith('.csv'):
+        filename = os.path.splitext(ns.profile)[0] + '.json'
+    profiler = from_args(ns, comm=comm, filename=filename)
+    
     # compute the tasks
     boxes = list(range(ns.start, ns.stop, ns.step))
     
+    # skip finished boxes, and do the slowest first
+    journal = Journal(ns.journal if ns.journal is not None else ns.config[0] + '.journal')
+    if rank == 0:
+        with profiler.stage('schedule'):
+            outputs = BianchiWrapper(ns.config).outputs
+            force = ns.force or ns.reduce is not None # reductions need every box
+            boxes = journal.schedule(boxes, outputs, force=force)
+        logging.info("%d boxes remaining" %len(boxes))
+    boxes = comm.bcast(boxes, root=0)
+    
+    # with prefetching, each worker runs a fixed share of the boxes, in order,
+    # so that its next box is known; the boxes are dealt out slowest first
+    tasks = boxes
+    if ns.prefetch:
+        nworkers = max((comm.size if ns.use_all_cpus else comm.size-1) // ns.N, 1)
+        tasks = [boxes[w::nworkers] for w in range(nworkers) if len(boxes[w::nworkers])]
+    
     # initialize the algorithm wrapper
-    bianchi = BianchiWrapper(ns.config)
+    kws = {'prefetch':ns.prefetch, 'journal':journal}
+    kws['profile'] = ns.profile is not None
+    if ns.reduce is not None:
+        rkws = {'weights':ns.reduce_weights, 'sum_only':ns.reduce_sum_only, 'covariance':ns.covariance}
+        kws['reducers'] = [EnsembleReducer(**rkws) for c in ns.config]
+    kws['save'] = not ns.no_save
+    kws['output_format'] = ns.output_format
+    bianchi = BianchiWrapper(ns.config, **kws)
     
     # initialize the worker pool
     kws = {'comm':comm, 'use_all_cpus':ns.use_all_cpus, 'debug':ns.debug}
     manager = TaskManager(bianchi, ns.N, **kws)
-       
+    
     # do the work
-    results = manager.compute(boxes)
+    with profiler.stage('compute'):
+        results = manager.compute(tasks)
+    
+    # collect the binary results of all boxes into a single archive per template
+    if ns.pack is not None and rank == 0:
+        with profiler.stage('pack'):
+            for j, output in enumerate(bianchi.outputs):
+                filenames = [output.format(box=box) for box in range(ns.start, ns.stop, ns.step)]
+                entries = ((f,) + load_result(f) for f in filenames if os.path.exists(f))
+                archive = ns.pack.format(config=j)
+                N = write_packed(archive, entries)
+                logging.info("packed %d results into `%s`" %(N, archive))
     
+    # merge the reductions of all workers and save
+    if ns.reduce is not None:
+        with profiler.stage('reduce'):
+            reducers = comm.gather(bianchi.reducers, root=0)
+            if rank == 0:
+                for j in range(len(ns.config)):
+                    reducer = EnsembleReducer(**rkws)
+                    for r in reducers:
+                        reducer.merge(r[j])
+                    output = ns.reduce.format(config=j)
+                    reducer.save(output)
+                    logging.info("saved the reduction of %d boxes to `%s`" %(len(reducer), output))
+    
+    # gather the per-box timings from all ranks and write the profile
+    if ns.profile is not None:
+        timings = comm.gather(bianchi.timings, root=0)
+        extra = {}
+        if rank == 0:
+            records = [r for t in timings for r in t]
+            extra = {'records':records, 'box_summary':summarize_profile(records)}
+            if ns.profile.endswith('.csv'):
+                write_profile(ns.profile, records)
+            for key, s in sorted(extra['box_summary'].items()):
+                args = (key, s['min'], s['median'], s['max'])
+                logging.info("%-10s min = %.3f, median = %.3f, max = %.3f" %args)
+        profiler.save(**extra)
+
 
 if __name__ == '__main__' :
     
@@ -100,8 +607,10 @@ if __name__ == '__main__' :
     h = 'the iteration step'
     parser.add_argument('--step', type=int, default=1, help=h)
 
-    # the template config file
-    parser.add_argument('-c', '--config', type=str, help=h, required=True)
+    # the template config files
+    h = "the template config file(s); multiple templates are all run on each box, " + \
+        "sharing the ``data`` and ``randoms`` DataSources where they are identical"
+    parser.add_argument('-c', '--config', type=str, nargs='+', help=h, required=True)
         
     h = "set the logging output to debug, with lots more info printed"
     parser.add_argument('--debug', action="store_true", help=h)
@@ -109,7 +618,60 @@ if __name__ == '__main__' :
     h = "if `True`, include all available cpus in the worker pool"
     parser.add_argument('--use_all_cpus', action='store_true', help=h)
     
+    h = "read the input files of the next box in a background thread, " + \
+        "while the current box is processed; each worker then runs a fixed " + \
+        "share of the boxes, rather than taking the next box as it finishes; " + \
+        "catalogs stored as directories are warmed in full"
+    parser.add_argument('--prefetch', action='store_true', help=h)
+    
+    h = "the journal of finished boxes, used to skip completed boxes and to " + \
+        "order the remaining boxes by their recorded times; default is `<first config>.journal`"
+    parser.add_argument('--journal', type=str, help=h)
+    
+    h = "recompute all boxes, even if the journal records them as complete"
+    parser.add_argument('--force', action='store_true', help=h)
+    
+    h = "write the per-box, per-rank time spent in each stage and the peak " + \
+        "RSS (in MB), and the time spent in each stage of the batch, to this JSON " + \
+        "file; if it ends in `.csv`, the boxes are written as CSV and the rest to `<name>.json`"
+    add_profile_arguments(parser, help=h)
+    
+    h = "keep a running mean of the results in memory, reduce it across " + \
+        "the workers at the end, and save it to this ``.npz`` file; with multiple " + \
+        "templates, the name must contain a ``{config}`` keyword, the template index"
+    parser.add_argument('--reduce', type=str, help=h)
+    
+    h = "the name of the column to weight the reduced mean by, as ``--weights`` " + \
+        "of ``mean_from_files.py``"
+    parser.add_argument('--reduce_weights', type=str, default='modes', help=h)
+    
+    h = "the columns which are summed over, not averaged, in the reduction, as " + \
+        "``--sum_only`` of ``mean_from_files.py``"
+    parser.add_argument('--reduce_sum_only', nargs='*', default=['modes'], help=h)
+    
+    h = "also reduce the covariance of the multipoles across boxes"
+    parser.add_argument('--covariance', action='store_true', help=h)
+    
+    h = "do not save the result of each box, i.e., when only the reduction is needed"
+    parser.add_argument('--no_save', action='store_true', help=h)
+    
+    h = "the format of the result of each box: the nbodykit plain text " + \
+        "format, or a binary ``.npz`` file (keeping the ``output`` name)"
+    parser.add_argument('--output_format', choices=['plaintext', 'npz'], default='plaintext', help=h)
+    
+    h = "collect the binary results of all boxes into this single, memory mappable " + \
+        "archive, readable by ``mean_from_files.py``; with multiple templates, the " + \
+        "name must contain a ``{config}`` keyword"
+    parser.add_argument('--pack', type=str, help=h)
+    
     ns = parser.parse_args()
+    if ns.no_save and ns.reduce is None:
+        parser.error("`--no_save` requires `--reduce`")
+    for name in ['reduce', 'pack']:
+        if getattr(ns, name) is not None and len(ns.config) > 1 and '{config}' not in getattr(ns, name):
+            parser.error("`--%s` must contain a `{config}` keyword when using multiple templates" %name)
+    if ns.pack is not None and (ns.output_format != 'npz' or ns.no_save):
+        parser.error("`--pack` requires `--output_format npz`")
     
     main(ns)
     
@@ -1,7 +1,11 @@
 from argparse import ArgumentParser
 import numpy as np
 import os
-import pandas as pd
+from mbii import CENTRAL, SATELLITE, SUBTYPE_LABELS
+from mbii import galaxy_types, compute_subtypes, haloid_files
+from mbii import open_binary, iter_chunks, load_occupancy, lookup_occupancy, load_halo_sizes
+from mbii import read_slices, parallel_halo_sizes, parallel_write
+from profiling import add_profile_arguments, from_args
 
 
 desc = "compute galaxy subtypes (A/B) for MBII central and satellite populations"
@@ -10,74 +14,114 @@ parser = ArgumentParser(desc)
 # add the positional arguments
 parser.add_argument("path", help="path to MBII simulation files")
 parser.add_argument("simulation", help="name of simulation", choices=["dmo", "mb2"])
+parser.add_argument("--chunksize", type=int, help="if provided, memory map the input files and " + \
+                        "process at most this many galaxies at a time")
+parser.add_argument("--no_index", action='store_true', help="do not read or write the " + \
+                        "persisted halo occupancy index")
+parser.add_argument("--use_mpi", action='store_true', help="distribute the galaxies across the " + \
+                        "ranks of MPI.COMM_WORLD, partitioning by halo id")
+add_profile_arguments(parser)
 args = parser.parse_args()
 
 
-def add_halo_sizes(df):
+def main_chunked(profiler):
     """
-    Compute number of centrals/satellites per halo and add to the 
-    input DataFrame as a column
+    Compute the subtypes out-of-core, such that the peak memory is set 
+    by `chunksize` and the number of unique halos
     """
-    # delete N_sat, N_cen columns if they exist
-    if 'N_sat' in df.columns: del df['N_sat']
-    if 'N_cen' in df.columns: del df['N_cen']
-    
-    # these are grouped by type and then by halo id
-    halos = df.groupby(['type', 'haloid'])
+    path_args = (args.path, args.simulation)
+    cen_file, sat_file = haloid_files(*path_args)
+    sources = [(open_binary(cen_file, 'i8'), CENTRAL), (open_binary(sat_file, 'i8'), SATELLITE)]
     
-    # the sizes
-    sizes = halos.size()
+    # build the halo occupancy table chunk by chunk
+    with profiler.stage('occupancy'):
+        table = load_occupancy(args.path, args.simulation, chunksize=args.chunksize, use_index=not args.no_index)
     
-    # add N_cen if there are any centrals in this sample
-    if 'central' in sizes.index.levels[0]:
-        N_cen = pd.DataFrame(sizes['central'], columns=['N_cen'])
-        df = df.join(N_cen, on='haloid', how='left')
-        
-        # now fill missing values with zeros
-        df.N_cen.fillna(value=0., inplace=True)
+    # stream the subtypes back out
+    outputs = ['{}/Centrals/{}_subtype'.format(*path_args), '{}/Satellites/{}_subtype'.format(*path_args)]
+    for (haloids, t), output in zip(sources, outputs):
+        with profiler.stage('subtypes'), open(output, 'wb') as ff:
+            for start, stop in iter_chunks(len(haloids), args.chunksize):
+                _, N_sat = lookup_occupancy(table, haloids[start:stop])
+                types = np.empty(stop-start, dtype='i1')
+                types[:] = t
+                SUBTYPE_LABELS[compute_subtypes(types, N_sat)].tofile(ff)
     
-    # add the satellites
-    if 'satellite' in sizes.index.levels[0]:
-        N_sat = pd.DataFrame(sizes['satellite'], columns=['N_sat'])
-        df = df.join(N_sat, on='haloid', how='left')
 
-        # now fill missing values with zeros
-        df.N_sat.fillna(value=0., inplace=True)
+def main_mpi(profiler, comm):
+    """
+    Compute the subtypes with the galaxies distributed across MPI ranks
     
-    return df
-        
-        
-def main():
+    Each rank reads a slice of the input files, galaxies are shuffled such
+    that all members of a halo land on one rank, and the subtypes are
+    returned to, and written by, the rank that read them
+    """
+    # read this rank's slice of the sat and cen halos
+    path_args = (args.path, args.simulation)
+    with profiler.stage('read'):
+        haloids, slices = read_slices(comm, haloid_files(*path_args), 'i8')
+    (cen_start, cen_stop, _), (sat_start, sat_stop, _) = slices
+    types = galaxy_types(cen_stop-cen_start, sat_stop-sat_start)
+    
+    # central and satellite subtypes
+    with profiler.stage('occupancy'):
+        N_cen, N_sat = parallel_halo_sizes(comm, haloids, types)
+    with profiler.stage('subtypes'):
+        subtypes = SUBTYPE_LABELS[compute_subtypes(types, N_sat)]
+    
+    # write out subtypes in the original order
+    outputs = ['{}/Centrals/{}_subtype'.format(*path_args), '{}/Satellites/{}_subtype'.format(*path_args)]
+    offset = 0
+    for (start, stop, N), output in zip(slices, outputs):
+        with profiler.stage('write'):
+            parallel_write(comm, output, subtypes[offset:offset+stop-start], start, N)
+        offset += stop-start
     
+
+def main_serial(profiler):
+    """
+    Compute the subtypes with all galaxies held in memory
+    """
     # load sat and cen halos
     path_args = (args.path, args.simulation)
-    haloid_cen = np.fromfile("{}/Centrals/{}_cenHaloID".format(*path_args), dtype=('i8'))
-    haloid_sat = np.fromfile("{}/Satellites/{}_satHaloID".format(*path_args), dtype=('i8'))
-    haloids = np.concatenate([haloid_cen, haloid_sat])
+    cen_file, sat_file = haloid_files(*path_args)
+    with profiler.stage('read'):
+        haloid_cen = np.fromfile(cen_file, dtype=('i8'))
+        haloid_sat = np.fromfile(sat_file, dtype=('i8'))
+        haloids = np.concatenate([haloid_cen, haloid_sat])
     
-    # make the dataframe
-    types = np.concatenate([np.repeat(['central'], len(haloid_cen)), np.repeat(['satellite'], len(haloid_sat))])
-    data = {'type' : types, 'haloid' : haloids}
-    df = pd.DataFrame(data=data)
+    # the integer type codes
+    Ncen = len(haloid_cen)
+    types = galaxy_types(Ncen, len(haloid_sat))
     
     # add halo sizes
-    df = add_halo_sizes(df)
+    with profiler.stage('occupancy'):
+        N_cen, N_sat = load_halo_sizes(args.path, args.simulation, haloids, types, use_index=not args.no_index)
     
-    # central subtypes
-    df.loc[(df.type == 'central')&(df.N_sat == 0), 'subtype'] = 'A'
-    df.loc[(df.type == 'central')&(df.N_sat > 0), 'subtype'] = 'B'
+    # central and satellite subtypes
+    with profiler.stage('subtypes'):
+        subtypes = SUBTYPE_LABELS[compute_subtypes(types, N_sat)]
     
-    # satellite subtypes
-    df.loc[(df.type == 'satellite')&(df.N_sat == 1), 'subtype'] = 'A'
-    df.loc[(df.type == 'satellite')&(df.N_sat > 1), 'subtype'] = 'B'
+    # write out subtypes
+    with profiler.stage('write'):
+        subtypes[:Ncen].tofile('{}/Centrals/{}_subtype'.format(*path_args))
+        subtypes[Ncen:].tofile('{}/Satellites/{}_subtype'.format(*path_args))
     
-    # split back into cens and sats
-    df_cen = df.loc[df.type == 'central']
-    df_sat = df.loc[df.type == 'satellite']
+def main():
     
-    # write out subtypes
-    df_cen.subtype.values.astype('S1').tofile('{}/Centrals/{}_subtype'.format(*path_args))
-    df_sat.subtype.values.astype('S1').tofile('{}/Satellites/{}_subtype'.format(*path_args))
+    comm = None
+    if args.use_mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    profiler = from_args(args, comm=comm)
+    
+    if comm is not None:
+        main_mpi(profiler, comm)
+    elif args.chunksize is not None:
+        main_chunked(profiler)
+    else:
+        main_serial(profiler)
+    profiler.save()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,7 +1,11 @@
 from argparse import ArgumentParser
 import numpy as np
 import os
-import pandas as pd
+from mbii import CENTRAL, SATELLITE, SUBTYPE_B
+from mbii import galaxy_types, compute_subtypes, haloid_files
+from mbii import load_halo_sizes, subtype_counts
+from mbii import read_slices, parallel_halo_sizes
+from profiling import add_profile_arguments, from_args
 
 
 desc = "count galaxy subtypes for MBII central and satellite populations"
@@ -12,93 +16,162 @@ parser.add_argument("path", help="path to MBII simulation files")
 parser.add_argument("simulation", help="name of simulation", choices=["dmo", "mb2"])
 parser.add_argument("--min_logmass", type=float, help="the minimum log10 mass to include")
 parser.add_argument("--max_logmass", type=float, help="the maximum log10 mass to include")
+parser.add_argument("--mass_bins", type=float, nargs='+', help="compute the counts and fractions " + \
+                        "in each of the log10 mass bins defined by these edges")
+parser.add_argument("--cumulative", action='store_true', help="with `--mass_bins`, use each edge " + \
+                        "as a threshold, including all galaxies with log10 mass above it")
+parser.add_argument("--output", type=str, help="with `--mass_bins`, save the table to this file")
+parser.add_argument("--no_index", action='store_true', help="do not read or write the " + \
+                        "persisted halo occupancy index")
+parser.add_argument("--use_mpi", action='store_true', help="distribute the galaxies across the " + \
+                        "ranks of MPI.COMM_WORLD, partitioning by halo id")
+add_profile_arguments(parser)
 args = parser.parse_args()
 
 
-def add_halo_sizes(df):
+def mass_files(path, simulation):
     """
-    Compute number of centrals/satellites per halo and add to the 
-    input DataFrame as a column
+    Return the names of the central and satellite mass files
     """
-    # delete N_sat, N_cen columns if they exist
-    if 'N_sat' in df.columns: del df['N_sat']
-    if 'N_cen' in df.columns: del df['N_cen']
-    
-    # these are grouped by type and then by halo id
-    halos = df.groupby(['type', 'haloid'])
-    
-    # the sizes
-    sizes = halos.size()
-    
-    # add N_cen if there are any centrals in this sample
-    if 'central' in sizes.index.levels[0]:
-        N_cen = pd.DataFrame(sizes['central'], columns=['N_cen'])
-        df = df.join(N_cen, on='haloid', how='left')
-        
-        # now fill missing values with zeros
-        df.N_cen.fillna(value=0., inplace=True)
-    
-    # add the satellites
-    if 'satellite' in sizes.index.levels[0]:
-        N_sat = pd.DataFrame(sizes['satellite'], columns=['N_sat'])
-        df = df.join(N_sat, on='haloid', how='left')
-
-        # now fill missing values with zeros
-        df.N_sat.fillna(value=0., inplace=True)
-    
-    return df
-        
-        
-def main():
+    return ["{}/Centrals/{}_mass".format(path, simulation),
+            "{}/Satellites/{}_mass".format(path, simulation)]
     
+
+def load_galaxies():
+    """
+    Return the log10 mass, type code and number of satellites in the 
+    halo of each galaxy
+    """
     # load sat and cen halos
     path_args = (args.path, args.simulation)
-    haloid_cen = np.fromfile("{}/Centrals/{}_cenHaloID".format(*path_args), dtype=('i8'))
-    haloid_sat = np.fromfile("{}/Satellites/{}_satHaloID".format(*path_args), dtype=('i8'))
+    cen_file, sat_file = haloid_files(*path_args)
+    haloid_cen = np.fromfile(cen_file, dtype=('i8'))
+    haloid_sat = np.fromfile(sat_file, dtype=('i8'))
     haloids = np.concatenate([haloid_cen, haloid_sat])
 
     # read mass
-    mass_cen = np.log10(np.fromfile("{}/Centrals/{}_mass".format(*path_args), dtype=('f8')))
-    mass_sat = np.log10(np.fromfile("{}/Satellites/{}_mass".format(*path_args), dtype=('f8')))
+    mass_cen, mass_sat = mass_files(*path_args)
+    mass_cen = np.log10(np.fromfile(mass_cen, dtype=('f8')))
+    mass_sat = np.log10(np.fromfile(mass_sat, dtype=('f8')))
     logmass = np.concatenate([mass_cen, mass_sat])
     
-    # make the dataframe
-    types = np.concatenate([np.repeat(['central'], len(haloid_cen)), np.repeat(['satellite'], len(haloid_sat))])
-    data = {'type' : types, 'haloid' : haloids, 'logmass' : logmass}
-    df = pd.DataFrame(data=data)
+    # the integer type codes
+    types = galaxy_types(len(haloid_cen), len(haloid_sat))
     
     # add halo sizes
-    df = add_halo_sizes(df)
+    N_cen, N_sat = load_halo_sizes(args.path, args.simulation, haloids, types, use_index=not args.no_index)
+    return logmass, types, N_sat
+    
+    
+def load_galaxies_mpi(comm):
+    """
+    Return the log10 mass, type code and number of satellites in the 
+    halo of each galaxy in this rank's slice of the input files
+    """
+    path_args = (args.path, args.simulation)
+    haloids, slices = read_slices(comm, haloid_files(*path_args), 'i8')
+    mass, _ = read_slices(comm, mass_files(*path_args), 'f8')
+    (cen_start, cen_stop, _), (sat_start, sat_stop, _) = slices
+    types = galaxy_types(cen_stop-cen_start, sat_stop-sat_start)
+    
+    # shuffle the galaxies by halo to compute the halo sizes
+    N_cen, N_sat = parallel_halo_sizes(comm, haloids, types)
+    return np.log10(mass), types, N_sat
     
-    mask = np.ones(len(df), dtype=bool)
+    
+def count_subtypes(logmass, types, N_sat):
+    """
+    Count the galaxies of each type and subtype, in a single bin or in 
+    each of the mass bins given by `args.mass_bins`, using a single `bincount`
+    
+    Returns
+    -------
+    counts : array_like
+        the counts, with shape `(Nbins, 2, 2)`; see `subtype_counts`
+    """
+    mask = np.ones(len(types), dtype=bool)
     if args.min_logmass is not None:
-        mask &= (df.logmass >= args.min_logmass)
+        mask &= (logmass >= args.min_logmass)
     if args.max_logmass is not None:
-        mask &= (df.logmass <= args.max_logmass)
-    df = df.loc[mask]
+        mask &= (logmass <= args.max_logmass)
+    logmass = logmass[mask]
+    types = types[mask]
     
-    # central subtypes
-    df.loc[(df.type == 'central')&(df.N_sat == 0), 'subtype'] = 'A'
-    df.loc[(df.type == 'central')&(df.N_sat > 0), 'subtype'] = 'B'
+    # central and satellite subtypes
+    subtypes = compute_subtypes(types, N_sat[mask])
     
-    # satellite subtypes
-    df.loc[(df.type == 'satellite')&(df.N_sat == 1), 'subtype'] = 'A'
-    df.loc[(df.type == 'satellite')&(df.N_sat > 1), 'subtype'] = 'B'
+    # everything in a single bin
+    if args.mass_bins is None:
+        return subtype_counts(np.zeros(len(types), dtype='i8'), types, subtypes, 1)
+    
+    # the bin index of each galaxy; the last, open-ended bin is 
+    # only needed for cumulative thresholds
+    edges = np.array(args.mass_bins)
+    index = np.digitize(logmass, edges) - 1
+    Nbins = len(edges) if args.cumulative else len(edges)-1
+    valid = (index >= 0)&(index < Nbins)
+    return subtype_counts(index[valid], types[valid], subtypes[valid], Nbins)
+    
+    
+def mass_binned_table(counts):
+    """
+    Compute the table of counts and fractions of each type and subtype 
+    in the mass bins given by `args.mass_bins`
+    """
+    edges = np.array(args.mass_bins)
+    Nbins = len(counts)
+    
+    # cumulative counts above each threshold
+    if args.cumulative:
+        counts = counts[::-1].cumsum(axis=0)[::-1]
+        lower, upper = edges, np.inf*np.ones(Nbins)
+    else:
+        lower, upper = edges[:-1], edges[1:]
+    counts = 1.*counts
+    
+    Ncen = counts[:,CENTRAL].sum(axis=-1)
+    Nsat = counts[:,SATELLITE].sum(axis=-1)
+    Ngal = Ncen + Nsat
+    NcB = counts[:,CENTRAL,SUBTYPE_B]
+    NsB = counts[:,SATELLITE,SUBTYPE_B]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fractions = [Nsat/Ngal, NcB/Ncen, NsB/Nsat]
+    
+    names = ['logM_min', 'logM_max', 'N_gal', 'N_cen', 'N_sat', 'N_cenB', 'N_satB', 'fsat', 'f_cenB', 'f_satB']
+    return names, np.vstack([lower, upper, Ngal, Ncen, Nsat, NcB, NsB] + fractions).T
+    
+
+def print_counts(counts):
+    """
+    Print the fractions of each type and subtype, or the table of counts
+    and fractions in the mass bins given by `args.mass_bins`
+    """
+    # the table of counts and fractions in mass bins
+    if args.mass_bins is not None:
+        names, data = mass_binned_table(counts)
+        fmt = ['%.4f']*2 + ['%d']*5 + ['%.5f']*3
+        if args.output is not None:
+            np.savetxt(args.output, data, fmt=fmt, header=" ".join(names))
+        print " ".join(names)
+        for row in data:
+            print " ".join(f %x for f, x in zip(fmt, row))
+        return
     
     # total number of centrals/satellites
-    Ncen = 1.*(df.type == 'central').sum()
-    Nsat = 1.*(df.type == 'satellite').sum()
+    counts = 1.*counts[0]
+    Ncen = counts[CENTRAL].sum()
+    Nsat = counts[SATELLITE].sum()
     Ngal = Ncen + Nsat
     
     # satellite fraction
     fsat = Nsat / Ngal
 
     # cen B fraction
-    NcB = 1.*((df.type == 'central')&(df.subtype == 'B')).sum()
+    NcB = counts[CENTRAL,SUBTYPE_B]
     fcB = NcB / Ncen
     
     # sat B fraction
-    NsB = 1.*((df.type == 'satellite')&(df.subtype == 'B')).sum()
+    NsB = counts[SATELLITE,SUBTYPE_B]
     fsB = NsB / Nsat
     
     print "satellite fraction: N_sat / N_gal = %.5f" %fsat
@@ -106,5 +179,33 @@ def main():
     print "satellite type B fraction: N_satB / N_sat = %.5f" %fsB
     
     
+def main():
+    
+    if args.mass_bins is not None and (np.diff(args.mass_bins) <= 0).any():
+        raise ValueError("`mass_bins` must be strictly increasing")
+    if args.mass_bins is not None and len(args.mass_bins) < 2 and not args.cumulative:
+        raise ValueError("`mass_bins` needs at least two edges, unless `--cumulative` is given")
+    
+    comm = None
+    if args.use_mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    profiler = from_args(args, comm=comm)
+    
+    # count the galaxies, reducing across ranks when using MPI
+    with profiler.stage('load'):
+        galaxies = load_galaxies_mpi(comm) if comm is not None else load_galaxies()
+    with profiler.stage('count'):
+        counts = count_subtypes(*galaxies)
+    if comm is not None:
+        with profiler.stage('reduce'):
+            comm.Allreduce(MPI.IN_PLACE, counts)
+    
+    if comm is None or comm.rank == 0:
+        with profiler.stage('output'):
+            print_counts(counts)
+    profiler.save()
+    
+    
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,451 @@
+"""
+Binary storage of parsed nbodykit plain text files
+"""
+import os
+import json
+import struct
+import hashlib
+import tempfile
+import warnings
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from glob import glob
+import numpy as np
+
+# the magic string identifying a packed archive
+PACKED_MAGIC = 'NBKPACK1'
+
+# separates the archive name from the member name/pattern
+MEMBER_SEP = '::'
+
+# the magic string of ``.npz`` (zip) files
+NPZ_MAGIC = 'PK\x03\x04'
+
+def pack_metadata(meta):
+    """
+    Convert a metadata dictionary, as returned by the nbodykit plain text
+    readers, into a dictionary of arrays that can be stored with `numpy.savez`
+
+    Lists/tuples (i.e., the bin `edges` in 2D) are stored item by item
+    """
+    toret = {}
+    for key, val in meta.items():
+        if isinstance(val, (list, tuple)):
+            for i, v in enumerate(val):
+                toret['metalist__%d__%s' %(i, key)] = np.asarray(v)
+        else:
+            toret['meta__%s' %key] = np.asarray(val)
+    return toret
+
+def unpack_metadata(arrays):
+    """
+    The inverse of `pack_metadata`, returning the metadata dictionary
+    """
+    toret = {}; lists = {}
+    for name in arrays:
+        val = arrays[name]
+        if name.startswith('metalist__'):
+            _, i, key = name.split('__', 2)
+            lists.setdefault(key, {})[int(i)] = val
+        elif name.startswith('meta__'):
+            key = name.split('__', 1)[1]
+            toret[key] = val.item() if val.ndim == 0 else val
+    for key in lists:
+        toret[key] = [lists[key][i] for i in sorted(lists[key])]
+    return toret
+
+def write_npz(ff, data, meta):
+    """
+    Write `data` and its metadata `meta`, as returned by the nbodykit
+    plain text readers, to the ``.npz`` file (or open file object) `ff`
+    """
+    np.savez(ff, __data__=data, **pack_metadata(meta))
+
+def read_npz(filename):
+    """
+    Return the `(data, metadata)` stored with `write_npz`
+    """
+    with np.load(filename) as ff:
+        data = ff['__data__']
+        meta = unpack_metadata(dict((k, ff[k]) for k in ff.files if k != '__data__'))
+    return data, meta
+
+def is_npz(filename):
+    """
+    Return `True` if `filename` is a ``.npz`` file, whatever its extension
+    """
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as ff:
+        return ff.read(len(NPZ_MAGIC)) == NPZ_MAGIC
+
+@contextmanager
+def atomic_write(filename, mode='wb'):
+    """
+    Open a temporary file next to `filename` for writing, and rename it
+    to `filename` once the enclosed block completes
+
+    The file gets the usual permissions of a new file (given the umask),
+    and the temporary file is removed if the block raises
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as ff:
+            yield ff
+        umask = os.umask(0); os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+
+class ParseCache(object):
+    """
+    An on-disk cache of parsed plain text files, stored as ``.npz`` files
+
+    Entries are keyed by the absolute path, modification time and size of
+    the source file, so modified files never return stale results. The
+    least recently used entries are evicted once the total size of the
+    cache exceeds `max_size`
+
+    The cache directory is only scanned when the cache is created and when
+    evicting; in between, the total size is kept up to date from the entries
+    saved and removed by this process. Evicting frees an extra `headroom`
+    fraction of `max_size`, so a full cache is not scanned on every save
+
+    Parameters
+    ----------
+    cache_dir : str
+        the directory holding the cached files
+    max_size : float, optional
+        the maximum size of the cache in MB; if `None`, there is no limit
+    headroom : float, optional
+        the fraction of `max_size` to free in addition when evicting
+    """
+    def __init__(self, cache_dir, max_size=None, headroom=0.1):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.headroom = headroom
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir): raise
+        self.total = sum(e[1] for e in self._entries()) if max_size is not None else 0
+
+    def path(self, filename, mode):
+        """
+        The name of the cache file for `filename`, read in `mode`
+        """
+        s = os.stat(filename)
+        key = "%s:%s:%r:%d" %(os.path.abspath(filename), mode, s.st_mtime, s.st_size)
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest() + '.npz')
+
+    def load(self, filename, mode):
+        """
+        Return the cached `(data, metadata)` for `filename`, or `None`
+        if there is no valid entry
+        """
+        path = self.path(filename, mode)
+        if not os.path.exists(path):
+            return None
+        try:
+            data, meta = read_npz(path)
+        except Exception:
+            self._remove(path)
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data, meta
+
+    def save(self, filename, mode, data, meta):
+        """
+        Store the parsed `(data, metadata)` of `filename` in the cache
+        """
+        path = self.path(filename, mode)
+        try:
+            with atomic_write(path) as ff:
+                write_npz(ff, data, meta)
+                size = ff.tell()
+        except (IOError, OSError) as e:
+            warnings.warn("unable to cache `%s`: %s" %(filename, str(e)))
+            return
+        self.total += size
+        if self.max_size is not None and self.total > self.max_size * 1024**2:
+            self.evict()
+
+    def read(self, filename, mode, reader):
+        """
+        Return the `(data, metadata)` for `filename`, using the cache if
+        possible and calling `reader(filename)` otherwise
+        """
+        toret = self.load(filename, mode)
+        if toret is None:
+            toret = reader(filename)
+            self.save(filename, mode, *toret)
+        return toret
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the total size
+        of the cache is below `max_size`, less the `headroom`
+        """
+        if self.max_size is None:
+            return
+
+        # rescan, to account for the entries of other processes
+        entries = self._entries()
+        self.total = sum(e[1] for e in entries)
+        if self.total <= self.max_size * 1024**2:
+            return
+        target = (1. - self.headroom) * self.max_size * 1024**2
+        for _, size, path in sorted(entries):
+            if self.total <= target: break
+            self._remove(path, size)
+
+    def _entries(self):
+        """
+        The `(mtime, size, path)` of each entry in the cache directory
+        """
+        toret = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz'): continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                s = os.stat(path)
+            except OSError:
+                continue
+            toret.append((s.st_mtime, s.st_size, path))
+        return toret
+
+    def _remove(self, path, size=None):
+        try:
+            if size is None: size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.total -= size
+
+
+def _dtype_to_json(dtype):
+    return dtype.descr if dtype.names else dtype.str
+
+def _dtype_from_json(descr):
+    if isinstance(descr, list):
+        return np.dtype([tuple(str(x) if isinstance(x, unicode) else x for x in f) for f in descr])
+    return np.dtype(str(descr))
+
+def _write_blob(ff, arr, align=64):
+    """
+    Write `arr` to the open file `ff`, aligned to `align` bytes, and
+    return the reference needed to memory map it again
+    """
+    arr = np.array(arr, order='C', copy=False)
+    pad = -ff.tell() % align
+    ff.write('\0'*pad)
+    ref = {'offset':ff.tell(), 'dtype':_dtype_to_json(arr.dtype), 'shape':list(arr.shape)}
+    ff.write(arr.tostring())
+    return ref
+
+def write_packed(filename, entries):
+    """
+    Write a set of parsed plain text files to a single packed archive
+
+    The archive consists of the raw, aligned bytes of each array followed 
+    by a JSON index holding their offsets, so that members can be read 
+    back with `PackedArchive` as zero-copy views of a memory map
+
+    Parameters
+    ----------
+    filename : str
+        the name of the archive to write
+    entries : iterable
+        an iterable of `(name, data, metadata)` tuples, where `data` 
+        and `metadata` are as returned by the nbodykit plain text readers
+
+    Returns
+    -------
+    N : int
+        the number of members written
+    """
+    index = []
+    with atomic_write(filename) as ff:
+        ff.write(PACKED_MAGIC)
+        for name, data, meta in entries:
+            entry = {'name':name, 'data':_write_blob(ff, data), 'meta':{}}
+            for k, v in pack_metadata(meta).items():
+                entry['meta'][k] = _write_blob(ff, v)
+            index.append(entry)
+
+        offset = ff.tell()
+        ff.write(json.dumps({'version':1, 'entries':index}))
+        ff.write(struct.pack('<Q', offset))
+        ff.write(PACKED_MAGIC)
+    return len(index)
+
+def is_packed(filename):
+    """
+    Return `True` if `filename` is a packed archive
+    """
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as ff:
+        return ff.read(len(PACKED_MAGIC)) == PACKED_MAGIC
+
+
+class PackedArchive(object):
+    """
+    Read-only access to a packed archive written by `write_packed`
+
+    The archive is memory mapped (copy-on-write), and the arrays returned
+    by `read` are views of the map, so no data is copied until it is used
+
+    Parameters
+    ----------
+    filename : str
+        the name of the archive
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._map = np.memmap(filename, dtype='u1', mode='c')
+
+        N = len(PACKED_MAGIC)
+        if self._map[:N].tostring() != PACKED_MAGIC or self._map[-N:].tostring() != PACKED_MAGIC:
+            raise ValueError("`%s` is not a packed archive" %filename)
+        offset = struct.unpack('<Q', self._map[-N-8:-N].tostring())[0]
+        index = json.loads(self._map[offset:-N-8].tostring())
+
+        self._entries = index['entries']
+        self.names = [str(e['name']) for e in self._entries]
+        self._index = dict((name, i) for i, name in enumerate(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def _view(self, ref):
+        dtype = _dtype_from_json(ref['dtype'])
+        shape = tuple(ref['shape'])
+        size = int(np.prod(shape)) * dtype.itemsize
+        start = ref['offset']
+        return self._map[start:start+size].view(dtype).reshape(shape)
+
+    def read(self, name):
+        """
+        Return the `(data, metadata)` of the member `name` (or integer index)
+        """
+        i = name if isinstance(name, (int, long)) else self._index[name]
+        entry = self._entries[i]
+        data = self._view(entry['data'])
+        meta = unpack_metadata(dict((str(k), self._view(v)) for k, v in entry['meta'].items()))
+        return data, meta
+
+    def match(self, pattern='*'):
+        """
+        Return the names of the members matching the glob `pattern`
+        """
+        return [name for name in self.names if fnmatch(name, pattern)]
+
+
+# open archives, so members can be read without re-opening
+_archives = {}
+
+def split_member(source):
+    """
+    Split a source of the form ``archive::member`` into the archive
+    and member names, returning `(source, None)` for plain files
+    """
+    if MEMBER_SEP in source:
+        archive, member = source.split(MEMBER_SEP, 1)
+        if is_packed(archive):
+            return archive, member
+    elif is_packed(source):
+        return source, '*'
+    return source, None
+
+class Source(str):
+    """
+    The name of a source, as returned by `glob_sources`, which carries
+    its kind and its `source_key`, such that neither requires opening
+    the file again
+
+    The kind is one of `text` (a plain text file), `npz` (a binary
+    ``.npz`` result) or `member` (a member of a packed archive)
+    """
+    def __new__(cls, name, kind, key):
+        toret = str.__new__(cls, name)
+        toret.kind = kind
+        toret.key = key
+        return toret
+
+    def __reduce__(self):
+        return (Source, (str(self), self.kind, self.key))
+
+def source_kind(source):
+    """
+    Return the kind of `source`: `member`, `npz` or `text`; for a `Source`,
+    this is the kind resolved by `glob_sources`
+    """
+    if isinstance(source, Source):
+        return source.kind
+    if split_member(source)[1] is not None:
+        return 'member'
+    return 'npz' if is_npz(source) else 'text'
+
+def glob_sources(pattern):
+    """
+    Return the sources matching `pattern`, which is either a glob pattern
+    of plain text (or ``.npz``) files, or a packed archive, optionally 
+    followed by ``::`` and a glob pattern of the member names
+
+    The kind of the sources is resolved once per pattern, from the first
+    matching file, so all of the files matching a pattern must have the
+    same format
+    """
+    archive, member = split_member(pattern)
+    if member is not None:
+        prefix = os.path.abspath(archive) + MEMBER_SEP
+        names = open_archive(archive).match(member)
+        return [Source(archive + MEMBER_SEP + name, 'member', prefix + name) for name in names]
+
+    filenames = glob(pattern)
+    kind = 'npz' if len(filenames) and is_npz(filenames[0]) else 'text'
+    return [Source(f, kind, os.path.abspath(f)) for f in filenames]
+
+def source_key(source):
+    """
+    A key identifying `source`, independent of the working directory
+    """
+    if isinstance(source, Source):
+        return source.key
+    archive, member = split_member(source)
+    if member is None:
+        return os.path.abspath(source)
+    return os.path.abspath(archive) + MEMBER_SEP + member
+
+def open_archive(filename):
+    """
+    Return the (cached) `PackedArchive` for `filename`
+    """
+    key = os.path.abspath(filename)
+    if key not in _archives:
+        _archives[key] = PackedArchive(filename)
+    return _archives[key]
+
+def read_member(source):
+    """
+    Return the `(data, metadata)` of the archive member `source`
+    """
+    if isinstance(source, Source):
+        archive, member = source.split(MEMBER_SEP, 1)
+    else:
+        archive, member = split_member(source)
+    return open_archive(archive).read(member)
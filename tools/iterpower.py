@@ -1,7 +1,15 @@
 import argparse as ap
+import hashlib
+import json
 import os
+import re
 import string
-import tempfile
+import subprocess
+import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from fileio import atomic_write
+from profiling import add_profile_arguments, from_args
 
 def my_string_parse(formatter, s, keys):
     l = list(string.Formatter.parse(formatter, s))
@@ -66,8 +74,22 @@ def parse_args(desc, dims, coords):
     parser.add_argument('-p', '--config', required=True, type=param_file, help=h)
     h = 'the name of the file specifying the selection parameters'
     parser.add_argument('-s', '--select', default={}, type=extra_iter_values, help=h)
-    h = 'the job submission mode'
-    parser.add_argument('--mode', choices=['pbs', 'slurm'], default='pbs', help=h)
+    h = 'the job submission mode; `local` runs the job script on this machine'
+    parser.add_argument('--mode', choices=['pbs', 'slurm', 'local'], default='pbs', help=h)
+    h = 'the number of jobs to run at once, when running locally'
+    parser.add_argument('--nprocs', type=int, default=cpu_count(), help=h)
+    h = 'the directory to write the log of each job to, when running locally'
+    parser.add_argument('--log_dir', type=str, default='.', help=h)
+    h = 'the directory holding the rendered config files and the registry of results'
+    parser.add_argument('--cache_dir', type=str, default='.iterpower', help=h)
+    h = 'run all samples, even those whose config has already completed'
+    parser.add_argument('--force', action='store_true', help=h)
+    h = 'pack the samples into a manifest of config files, which is passed to the job ' + \
+        'script as ``manifest``, and submit either a single job `array`, where each task ' + \
+        'reads line ``$PBS_ARRAY_INDEX+1`` (or ``$SLURM_ARRAY_TASK_ID+1``) of the manifest, ' + \
+        'or a `single` job, i.e., one running ``manifest_batch.py``'
+    parser.add_argument('--pack', choices=['none', 'array', 'single'], default='none', help=h)
+    add_profile_arguments(parser)
     
     # add the samples
     for i, (dim, vals) in enumerate(zip(dims, coords)):
@@ -76,17 +98,214 @@ def parse_args(desc, dims, coords):
     
     return parser.parse_args()
 
+class ResultRegistry(object):
+    """
+    A registry of rendered config files, keyed by the hash of their contents
+    
+    The rendered configs are written to ``<cache_dir>/configs/<hash>.config``, 
+    and the registry, ``<cache_dir>/registry.json``, records the sample, 
+    output file and status of each, so that identical configs from earlier 
+    sweeps can be skipped
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir) # jobs may not run in this directory
+        self.filename = os.path.join(cache_dir, 'registry.json')
+        
+        config_dir = os.path.join(cache_dir, 'configs')
+        if not os.path.isdir(config_dir):
+            os.makedirs(config_dir)
+        
+        self.entries = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as ff:
+                self.entries = json.load(ff)
+                
+    @staticmethod
+    def hash(config):
+        """
+        The hash identifying the rendered ``config``
+        """
+        return hashlib.sha1(config).hexdigest()
+        
+    @staticmethod
+    def output(config):
+        """
+        The ``output`` file named by the rendered ``config``, or `None`
+        """
+        match = re.search(r'^output\s*:\s*(.+?)\s*$', config, re.M)
+        return match.group(1).strip('\'"') if match else None
+    
+    def manifest_file(self, filenames):
+        """
+        Write the manifest of config ``filenames``, one per line, to its 
+        hash-named file and return the file name
+        """
+        manifest = "\n".join(filenames) + "\n"
+        dirname = os.path.join(self.cache_dir, 'manifests')
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fname = os.path.join(dirname, self.hash(manifest) + '.txt')
+        with open(fname, 'w') as ff:
+            ff.write(manifest)
+        return fname
+        
+    def config_file(self, config):
+        """
+        Write the rendered ``config`` to its hash-named file, if it does 
+        not already exist, and return the file name
+        """
+        fname = os.path.join(self.cache_dir, 'configs', self.hash(config) + '.config')
+        if not os.path.exists(fname):
+            with open(fname, 'w') as ff:
+                ff.write(config)
+        return fname
+        
+    def is_complete(self, config):
+        """
+        Whether ``config`` has already completed: its output exists or, if
+        the output is not known, its job ran locally and succeeded
+        """
+        entry = self.entries.get(self.hash(config), None)
+        if entry is None:
+            return False
+        if entry['output'] is not None:
+            return os.path.exists(entry['output'])
+        return entry['status'] == 0
+        
+    def record(self, config, sample, status):
+        """
+        Record the ``status`` (an exit code or `submitted`) of ``config``
+        """
+        entry = {'sample':sample, 'output':self.output(config), 'status':status}
+        self.entries[self.hash(config)] = entry
+        
+    def save(self):
+        """
+        Write the registry to disk
+        """
+        with atomic_write(self.filename, 'w') as ff:
+            json.dump(self.entries, ff, indent=2, sort_keys=True)
+        
+
+def submit_command(job_file, env, mode, array=None):
+    """
+    The command submitting ``job_file`` with the environment variables 
+    ``env``, optionally as a job array of ``array`` tasks
+    """
+    env = ','.join('%s=%s' %(k, v) for k, v in sorted(env.items()))
+    if mode == 'pbs':
+        opts = '' if array is None else '-J 0-%d ' %(array-1)
+        return "qsub %s-v '%s' %s" %(opts, env, job_file)
+    else:
+        opts = '' if array is None else '--array=0-%d ' %(array-1)
+        return "sbatch %s\"--export=%s,ALL\" %s" %(opts, env, job_file)
+        
+def render_config(formatter, config, select, dims, sample):
+    """
+    Format the template ``config`` for a single sample, using the 
+    selection parameters of each of its dimensions
+    
+    Parameters
+    ----------
+    formatter : string.Formatter
+        the formatter to use
+    config : str
+        the template config
+    select : dict
+        the selection parameters, keyed by ``<dim>_<value>``
+    dims : list of str
+        the list of the dimensions for the samples
+    sample : tuple
+        the value of each dimension for this sample
+    """
+    # grab the kwargs to format for each dimension
+    kwargs = {}
+    for i, dim in enumerate(dims):
+        name = '%s_%s' %(dim, sample[i])
+        if name in select:
+            kwargs.update(select[name])
+    formatter.parse = lambda l: my_string_parse(formatter, l, kwargs.keys())
+    
+    all_kwargs = [kw for _, kw, _, _ in config._formatter_parser() if kw]
+    valid = {k:v for k,v in kwargs.iteritems() if k in all_kwargs}
+    return formatter.format(config, **valid)
+    
+def sample_name(dims, sample):
+    """
+    A name identifying the sample, i.e., for log files
+    """
+    return '_'.join('%s_%s' %(dim, val) for dim, val in zip(dims, sample))
+    
+def run_local(job_file, param_file, log_file, manifest=False):
+    """
+    Run the job script with ``param_file`` (or ``manifest``) set in the 
+    environment, writing its output to ``log_file``, and return the exit 
+    code and the time taken
+    """
+    env = dict(os.environ, **{'manifest' if manifest else 'param_file':param_file})
+    cmd = [os.path.abspath(job_file)] if os.access(job_file, os.X_OK) else ['sh', job_file]
+    start = time.time()
+    with open(log_file, 'w') as log:
+        try:
+            ret = subprocess.call(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            log.write("unable to run `%s`: %s\n" %(job_file, str(e)))
+            ret = -1
+    return ret, time.time() - start
+    
+def print_summary(results):
+    """
+    Print a table of the exit code, run time and log file of each sample
+    """
+    width = max([len('sample')] + [len(r['sample']) for r in results])
+    print "%-*s  %6s  %9s  %s" %(width, 'sample', 'status', 'time [s]', 'log')
+    for r in results:
+        print "%-*s  %6d  %9.1f  %s" %(width, r['sample'], r['status'], r['time'], r['log'])
+    failed = sum(r['status'] != 0 for r in results)
+    print "%d of %d samples succeeded" %(len(results)-failed, len(results))
+
 def submit_jobs(args, dims, coords, mode='pbs'):
     """
     Submit the job script specified on the command line for the desired 
-    sample(s). This could submit several job at once, but will 
-    wait 1 second in between doing so.  
+    sample(s). In `local` mode, the jobs are run on this machine instead, 
+    using at most ``args.nprocs`` processes at once
+    
+    If ``args.pack`` is `array` or `single`, the config files of all samples 
+    are written to a manifest, and a single job array or job is submitted
+    
+    Samples whose rendered config has already completed, according to 
+    the `ResultRegistry` in ``args.cache_dir``, are skipped unless 
+    ``args.force`` is set
+    
+    Returns
+    -------
+    results : list of dict, None
+        in `local` mode, the sample name, exit code, run time and log 
+        file of each job; otherwise, `None`
     """
-    import time
     import itertools
     
-    if mode not in ['pbs', 'slurm']:
-        raise ValueError("``mode`` must be `pbs` or `slurm`")
+    if mode not in ['pbs', 'slurm', 'local']:
+        raise ValueError("``mode`` must be `pbs`, `slurm` or `local`")
+    
+    # the time spent rendering, submitting and running
+    profiler = from_args(args)
+    
+    # the registry of rendered configs
+    registry = ResultRegistry(getattr(args, 'cache_dir', '.iterpower'))
+    force = getattr(args, 'force', False)
+    
+    # the packing mode; job arrays are only for the schedulers
+    pack = getattr(args, 'pack', 'none')
+    if mode == 'local' and pack == 'array':
+        pack = 'none'
+    packed_jobs = []
+    
+    # the jobs to run locally
+    local_jobs = []
+    log_dir = getattr(args, 'log_dir', '.')
+    if mode == 'local' and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
             
     # initialize a string formatter
     formatter = string.Formatter()
@@ -102,34 +321,76 @@ def submit_jobs(args, dims, coords, mode='pbs'):
     # loop over each sample iteration
     for sample in itertools.product(*samples):
         
-        # grab the kwargs to format for each dimension
-        kwargs = {}
-        for i, dim in enumerate(dims):
-            name = '%s_%s' %(dim, sample[i])
-            if name in args.select:
-                kwargs.update(args.select[name])
-        formatter.parse = lambda l: my_string_parse(formatter, l, kwargs.keys())
-    
-        # write out the formatted config file for this iteration
-        all_kwargs = [kw for _, kw, _, _ in args.config._formatter_parser() if kw]
-        with tempfile.NamedTemporaryFile(delete=False) as ff:
-            fname = ff.name
-            valid = {k:v for k,v in kwargs.iteritems() if k in all_kwargs}
-            ff.write(formatter.format(args.config, **valid))
-        
-        param_str = 'param_file=%s' %fname
-        if mode == 'pbs':
-            x = "qsub -v '%s' %s" %(param_str, args.job_file)
-        else:
-            x = "sbatch \"--export=%s,ALL\" %s" %(param_str, args.job_file)
+        # the formatted config file for this iteration
+        with profiler.stage('render'):
+            config = render_config(formatter, args.config, args.select, dims, sample)
+            name = sample_name(dims, sample)
+        
+        # skip configs that have already completed
+        with profiler.stage('registry'):
+            if not force and registry.is_complete(config):
+                print "skipping %s; already completed" %name
+                continue
+            fname = registry.config_file(config)
+        
+        if pack != 'none':
+            packed_jobs.append((name, config, fname))
+            continue
+        
+        if mode == 'local':
+            local_jobs.append((name, config, fname, os.path.join(log_dir, name + '.log')))
+            continue
+        
+        x = submit_command(args.job_file, {'param_file':fname}, mode)
         print "calling %s..." %x
-        ret = os.system(x)
+        with profiler.stage('submit'):
+            ret = os.system(x)
         print "...done"
-        time.sleep(1)
-
-    
+        with profiler.stage('registry'):
+            registry.record(config, name, 'submitted' if ret == 0 else ret)
+            registry.save()
         
-    
-    
-    
-    
\ No newline at end of file
+    # submit all of the samples at once
+    if pack != 'none' and len(packed_jobs):
+        manifest = registry.manifest_file([fname for _, _, fname in packed_jobs])
+        print "packed %d samples into manifest `%s`" %(len(packed_jobs), manifest)
+        if mode == 'local':
+            local_jobs.append(('manifest', None, manifest, os.path.join(log_dir, 'manifest.log')))
+        else:
+            array = len(packed_jobs) if pack == 'array' else None
+            x = submit_command(args.job_file, {'manifest':manifest}, mode, array=array)
+            print "calling %s..." %x
+            with profiler.stage('submit'):
+                ret = os.system(x)
+            print "...done"
+            with profiler.stage('registry'):
+                for name, config, fname in packed_jobs:
+                    registry.record(config, name, 'submitted' if ret == 0 else ret)
+                registry.save()
+        
+    if mode != 'local':
+        profiler.save()
+        return
+        
+    # run the local jobs on a bounded pool
+    nprocs = getattr(args, 'nprocs', None) or cpu_count()
+    print "running %d jobs locally, %d at a time..." %(len(local_jobs), nprocs)
+    pool = ThreadPool(nprocs)
+    try:
+        with profiler.stage('run'):
+            runs = pool.map(lambda job: run_local(args.job_file, job[2], job[3], manifest=job[1] is None), local_jobs)
+    finally:
+        pool.close()
+        
+    results = []
+    for (name, config, fname, log), (ret, elapsed) in zip(local_jobs, runs):
+        if config is None:
+            for name_, config_, _ in packed_jobs:
+                registry.record(config_, name_, ret)
+        else:
+            registry.record(config, name, ret)
+        results.append({'sample':name, 'status':ret, 'time':elapsed, 'log':log, 'param_file':fname})
+    registry.save()
+    print_summary(results)
+    profiler.save(jobs=results)
+    return results
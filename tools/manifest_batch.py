@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+
+import argparse
+import logging
+import yaml
+
+from mpi4py import MPI
+
+from nbodykit.extensionpoints import algorithms, Algorithm
+from nbodykit.utils.taskmanager import TaskManager
+
+# setup the logging
+comm = MPI.COMM_WORLD
+rank = MPI.COMM_WORLD.rank
+name = MPI.Get_processor_name()
+logging.basicConfig(level=logging.INFO,
+                    format='rank %d on %s: '%(rank,name) + \
+                            '%(asctime)s %(name)-15s %(levelname)-8s %(message)s',
+                    datefmt='%m-%d %H:%M')
+
+
+def read_manifest(filename):
+    """
+    Return the config files listed in the manifest, one per line
+    """
+    with open(filename, 'r') as ff:
+        return [line.strip() for line in ff if line.strip()]
+
+
+class ManifestWrapper(object):
+    """
+    Run an nbodykit algorithm for each config file of a manifest, as
+    written by ``iterpower.submit_jobs`` with ``--pack single``
+    """
+    def __init__(self, algorithm_name):
+        self.algorithm_name = algorithm_name
+    
+    def __call__(self, i, config_file):
+        
+        with open(config_file, 'r') as ff:
+            config = ff.read()
+        output = yaml.load(config)['output']
+        
+        # parse the config file and initialize the algorithm
+        params, extra = Algorithm.parse_known_yaml(self.algorithm_name, config)
+        algorithm = getattr(algorithms, self.algorithm_name)(**vars(params))
+        
+        # run and save
+        result = algorithm.run()
+        algorithm.save(output, result)
+        if algorithm.comm.rank == 0:
+            logging.info("finished `%s`, saved to `%s`" %(config_file, output))
+
+
+def main(ns):
+    
+    # the config files to run
+    configs = read_manifest(ns.manifest)
+    if rank == 0:
+        logging.info("running %d configs from `%s`" %(len(configs), ns.manifest))
+    
+    # initialize the worker pool
+    wrapper = ManifestWrapper(ns.algorithm)
+    kws = {'comm':comm, 'use_all_cpus':ns.use_all_cpus, 'debug':ns.debug}
+    manager = TaskManager(wrapper, ns.N, **kws)
+    
+    # do the work
+    results = manager.compute(configs)
+
+
+if __name__ == '__main__' :
+    
+    # parse
+    desc = "run an nbodykit algorithm in batch mode, iterating over the config " + \
+           "files listed in a manifest, i.e., as written by ``iterpower.py``"
+    parser = argparse.ArgumentParser(description=desc)
+    
+    # the number of independent workers
+    h = "the number of cpus per indepent worker"
+    parser.add_argument('N', type=int, help=h)
+    
+    # the algorithm
+    h = "the name of the nbodykit algorithm to run, i.e., `FFTPower`"
+    parser.add_argument('algorithm', type=str, help=h)
+    
+    # the manifest
+    h = "the manifest file, listing one config file per line"
+    parser.add_argument('manifest', type=str, help=h)
+    
+    h = "set the logging output to debug, with lots more info printed"
+    parser.add_argument('--debug', action="store_true", help=h)
+    
+    h = "if `True`, include all available cpus in the worker pool"
+    parser.add_argument('--use_all_cpus', action='store_true', help=h)
+    
+    ns = parser.parse_args()
+    
+    main(ns)
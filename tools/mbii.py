@@ -0,0 +1,419 @@
+"""
+Shared tools for computing the halo occupancy and subtypes of
+MBII central and satellite galaxies
+"""
+import os
+import hashlib
+import warnings
+from glob import glob
+import numpy as np
+from fileio import atomic_write
+
+# integer codes for the galaxy types
+CENTRAL, SATELLITE = 0, 1
+
+# integer codes for the galaxy subtypes
+SUBTYPE_A, SUBTYPE_B = 0, 1
+SUBTYPE_LABELS = np.array(['A', 'B'], dtype='S1')
+
+# the occupancy of each unique halo
+OCCUPANCY_DTYPE = np.dtype([('haloid', 'i8'), ('N_cen', 'i8'), ('N_sat', 'i8')])
+
+def galaxy_types(Ncen, Nsat):
+    """
+    Return the integer type codes for `Ncen` centrals followed
+    by `Nsat` satellites
+    """
+    types = np.empty(Ncen+Nsat, dtype='i1')
+    types[:Ncen] = CENTRAL
+    types[Ncen:] = SATELLITE
+    return types
+
+def halo_occupancy(haloids, types):
+    """
+    Compute the number of centrals and satellites in each halo
+
+    Parameters
+    ----------
+    haloids : array_like
+        the halo id of each galaxy
+    types : array_like
+        the integer type code of each galaxy
+
+    Returns
+    -------
+    uniq : array_like
+        the sorted, unique halo ids
+    N_cen, N_sat : array_like
+        the number of centrals and satellites in each of the unique halos
+    inverse : array_like
+        the indices into `uniq` of the halo of each galaxy
+    """
+    uniq, inverse = np.unique(haloids, return_inverse=True)
+    counts = np.bincount(2*inverse + types, minlength=2*len(uniq)).reshape(-1, 2)
+    return uniq, counts[:,CENTRAL], counts[:,SATELLITE], inverse
+
+def add_halo_sizes(haloids, types):
+    """
+    Compute the number of centrals and satellites in the halo of each galaxy
+
+    Returns
+    -------
+    N_cen, N_sat : array_like
+        the number of centrals and satellites in the halo of each galaxy
+    """
+    _, N_cen, N_sat, inverse = halo_occupancy(haloids, types)
+    return N_cen[inverse], N_sat[inverse]
+
+def compute_subtypes(types, N_sat):
+    """
+    Compute the integer subtype code of each galaxy
+
+    Centrals are type A if there are no satellites in their halo, and
+    type B otherwise; satellites are type A if they are the only
+    satellite in their halo, and type B otherwise
+    """
+    threshold = np.where(types == CENTRAL, 0, 1)
+    return (N_sat > threshold).astype('i1')
+
+def subtype_counts(bin_index, types, subtypes, Nbins):
+    """
+    Count the galaxies in each bin, by type and subtype, in a single pass
+
+    Parameters
+    ----------
+    bin_index : array_like
+        the bin index of each galaxy, in the range `[0, Nbins)`
+    types, subtypes : array_like
+        the integer type and subtype codes of each galaxy
+    Nbins : int
+        the number of bins
+
+    Returns
+    -------
+    counts : array_like
+        the counts, with shape `(Nbins, 2, 2)`, indexed by bin, 
+        type and then subtype
+    """
+    flat = 4*bin_index + 2*types + subtypes
+    return np.bincount(flat, minlength=4*Nbins).reshape(Nbins, 2, 2)
+
+def open_binary(filename, dtype):
+    """
+    Memory map the binary file `filename`, holding an array of `dtype`
+    """
+    if os.path.getsize(filename) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r')
+
+def iter_chunks(N, chunksize):
+    """
+    Iterate over the `(start, stop)` bounds of chunks of size `chunksize`
+    """
+    for start in range(0, N, chunksize):
+        yield start, min(start+chunksize, N)
+
+def occupancy_table(haloids, types):
+    """
+    Return the occupancy table of the input galaxies, a structured array
+    with the sorted unique `haloid` and the number of centrals and 
+    satellites, `N_cen` and `N_sat`, in each halo
+    """
+    uniq, N_cen, N_sat, _ = halo_occupancy(haloids, types)
+    return _make_table(uniq, N_cen, N_sat)
+
+def _make_table(uniq, N_cen, N_sat):
+    """
+    The occupancy table of the sorted, unique halo ids `uniq`
+    """
+    toret = np.empty(len(uniq), dtype=OCCUPANCY_DTYPE)
+    toret['haloid'] = uniq
+    toret['N_cen'] = N_cen
+    toret['N_sat'] = N_sat
+    return toret
+
+def merge_occupancy(tables):
+    """
+    Merge a list of occupancy tables, summing the counts of halos in
+    more than one, with a single sort of the concatenated tables
+    """
+    # a single table is already sorted and unique
+    tables = [t for t in tables if len(t)]
+    if len(tables) == 1:
+        return tables[0]
+
+    table = np.concatenate([np.empty(0, dtype=OCCUPANCY_DTYPE)] + tables)
+    table = table[np.argsort(table['haloid'], kind='mergesort')]
+    start = np.flatnonzero(np.r_[True, table['haloid'][1:] != table['haloid'][:-1]]) if len(table) else []
+
+    toret = np.empty(len(start), dtype=OCCUPANCY_DTYPE)
+    toret['haloid'] = table['haloid'][start]
+    for name in ['N_cen', 'N_sat']:
+        toret[name] = np.add.reduceat(table[name], start) if len(start) else []
+    return toret
+
+def chunked_occupancy(sources, chunksize):
+    """
+    Build the occupancy table from (memory mapped) halo id arrays,
+    reading at most `chunksize` galaxies at a time
+
+    Parameters
+    ----------
+    sources : list
+        a list of `(haloids, type)` tuples, where `haloids` is an
+        array_like and `type` is the type code of all its galaxies
+    chunksize : int
+        the maximum number of galaxies to read at once
+
+    Returns
+    -------
+    table : array_like
+        the occupancy table; see `occupancy_table`
+    """
+    table = np.empty(0, dtype=OCCUPANCY_DTYPE)
+    pending = []; Npending = 0
+    for haloids, t in sources:
+        for start, stop in iter_chunks(len(haloids), chunksize):
+            h = np.asarray(haloids[start:stop])
+            types = np.empty(len(h), dtype='i1')
+            types[:] = t
+            pending.append(occupancy_table(h, types))
+            Npending += len(pending[-1])
+
+            # merge only once the pending chunks outgrow the merged table, such
+            # that each halo is merged a few times, rather than once per chunk,
+            # while the memory stays proportional to the number of unique halos
+            if Npending > len(table):
+                table = merge_occupancy([table] + pending)
+                pending = []; Npending = 0
+    return merge_occupancy([table] + pending)
+
+def lookup_occupancy(table, haloids):
+    """
+    Return the number of centrals and satellites in the halos of the
+    input galaxies, using the occupancy table `table`
+    """
+    index = np.searchsorted(table['haloid'], haloids)
+    index[index == len(table)] = 0
+    if not (table['haloid'][index] == haloids).all():
+        raise ValueError("halo ids are missing from the occupancy table")
+    return table['N_cen'][index], table['N_sat'][index]
+
+def haloid_files(path, simulation):
+    """
+    Return the names of the central and satellite halo id files
+    """
+    return ["{}/Centrals/{}_cenHaloID".format(path, simulation),
+            "{}/Satellites/{}_satHaloID".format(path, simulation)]
+
+def occupancy_index_file(path, simulation):
+    """
+    The name of the persisted occupancy index, which includes a hash of 
+    the path, size and modification time of the halo id files, such 
+    that the index is invalidated when the inputs change
+    """
+    key = []
+    for f in haloid_files(path, simulation):
+        s = os.stat(f)
+        key.append("%s:%d:%r" %(os.path.abspath(f), s.st_size, s.st_mtime))
+    digest = hashlib.sha1("\n".join(key)).hexdigest()[:16]
+    return "{}/{}_occupancy_{}.npy".format(path, simulation, digest)
+
+def load_occupancy(path, simulation, chunksize=None, use_index=True):
+    """
+    Return the occupancy table for a simulation
+
+    If a valid index exists next to the simulation files, it is memory
+    mapped; otherwise, the table is computed from the halo id files 
+    and the index is written, replacing any stale versions
+
+    Parameters
+    ----------
+    path : str
+        path to MBII simulation files
+    simulation : str
+        name of simulation
+    chunksize : int, optional
+        if provided, build the table out-of-core, reading at most this 
+        many galaxies at a time
+    use_index : bool, optional
+        if `False`, do not read or write the persisted index
+
+    Returns
+    -------
+    table : array_like
+        the occupancy table; see `occupancy_table`
+    """
+    index_file = occupancy_index_file(path, simulation)
+    if use_index and os.path.exists(index_file):
+        return np.load(index_file, mmap_mode='r')
+
+    # compute the table
+    cen_file, sat_file = haloid_files(path, simulation)
+    if chunksize is not None:
+        sources = [(open_binary(cen_file, 'i8'), CENTRAL), (open_binary(sat_file, 'i8'), SATELLITE)]
+        table = chunked_occupancy(sources, chunksize)
+    else:
+        haloid_cen = np.fromfile(cen_file, dtype='i8')
+        haloid_sat = np.fromfile(sat_file, dtype='i8')
+        types = galaxy_types(len(haloid_cen), len(haloid_sat))
+        table = occupancy_table(np.concatenate([haloid_cen, haloid_sat]), types)
+    if use_index:
+        write_occupancy_index(path, simulation, table)
+    return table
+
+def load_halo_sizes(path, simulation, haloids, types, use_index=True):
+    """
+    Return the number of centrals and satellites in the halo of each of
+    the input galaxies, which must be all galaxies of the simulation
+
+    If a valid index exists, the counts are looked up in it; otherwise,
+    they are computed from the galaxies already in memory, without 
+    reading the halo id files again, and the index is written
+
+    Parameters
+    ----------
+    path : str
+        path to MBII simulation files
+    simulation : str
+        name of simulation
+    haloids : array_like
+        the halo id of each galaxy
+    types : array_like
+        the integer type code of each galaxy
+    use_index : bool, optional
+        if `False`, do not read or write the persisted index
+
+    Returns
+    -------
+    N_cen, N_sat : array_like
+        the number of centrals and satellites in the halo of each galaxy
+    """
+    index_file = occupancy_index_file(path, simulation)
+    if use_index and os.path.exists(index_file):
+        return lookup_occupancy(np.load(index_file, mmap_mode='r'), haloids)
+
+    uniq, N_cen, N_sat, inverse = halo_occupancy(haloids, types)
+    if use_index:
+        write_occupancy_index(path, simulation, _make_table(uniq, N_cen, N_sat))
+    return N_cen[inverse], N_sat[inverse]
+
+def write_occupancy_index(path, simulation, table):
+    """
+    Write the occupancy index of a simulation, removing stale versions
+    """
+    index_file = occupancy_index_file(path, simulation)
+    try:
+        with atomic_write(index_file) as ff:
+            np.save(ff, table)
+    except (IOError, OSError) as e:
+        warnings.warn("unable to write occupancy index `%s`: %s" %(index_file, str(e)))
+        return
+    for f in glob("{}/{}_occupancy_*.npy".format(path, simulation)):
+        if f != index_file:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+def rank_slice(N, comm):
+    """
+    The `(start, stop)` bounds of this rank's share of `N` items
+    """
+    return N*comm.rank//comm.size, N*(comm.rank+1)//comm.size
+
+def halo_owner(haloids, size):
+    """
+    The rank owning each halo, from a multiplicative hash of the halo id,
+    such that all members of a halo are assigned to the same rank
+    """
+    h = np.asarray(haloids).astype('u8') * np.uint64(0x9E3779B97F4A7C15)
+    return ((h >> np.uint64(32)) % np.uint64(size)).astype('i8')
+
+def _alltoallv(comm, sendbuf, sendcounts, recvcounts):
+    """
+    Exchange the contiguous, rank-ordered blocks of `sendbuf`
+    """
+    from mpi4py import MPI
+
+    sendbuf = np.ascontiguousarray(sendbuf)
+    recvbuf = np.empty(recvcounts.sum(), dtype=sendbuf.dtype)
+    sdispls = np.concatenate([[0], sendcounts.cumsum()[:-1]])
+    rdispls = np.concatenate([[0], recvcounts.cumsum()[:-1]])
+    dtype = MPI._typedict[sendbuf.dtype.char]
+    comm.Alltoallv([sendbuf, (sendcounts, sdispls), dtype], [recvbuf, (recvcounts, rdispls), dtype])
+    return recvbuf
+
+def parallel_halo_sizes(comm, haloids, types):
+    """
+    Compute the number of centrals and satellites in the halo of each 
+    galaxy, when the galaxies are distributed across MPI ranks
+
+    Galaxies are shuffled with `Alltoallv` to the rank owning their halo,
+    as given by `halo_owner`, the occupancy is computed locally, and the
+    counts are returned to the original ranks in the input order
+
+    Parameters
+    ----------
+    comm : MPI.Communicator
+        the communicator
+    haloids, types : array_like
+        the halo ids and integer type codes of the galaxies on this rank
+
+    Returns
+    -------
+    N_cen, N_sat : array_like
+        the number of centrals and satellites in the halo of each galaxy
+    """
+    owner = halo_owner(haloids, comm.size)
+    order = np.argsort(owner, kind='mergesort')
+    sendcounts = np.bincount(owner, minlength=comm.size).astype('i8')
+    recvcounts = np.empty_like(sendcounts)
+    comm.Alltoall(sendcounts, recvcounts)
+
+    # shuffle by halo
+    recv_haloids = _alltoallv(comm, haloids[order], sendcounts, recvcounts)
+    recv_types = _alltoallv(comm, types[order], sendcounts, recvcounts)
+    N_cen, N_sat = add_halo_sizes(recv_haloids, recv_types)
+
+    # and back, in the original order
+    toret = []
+    for N in [N_cen, N_sat]:
+        x = np.empty(len(haloids), dtype=N.dtype)
+        x[order] = _alltoallv(comm, N, recvcounts, sendcounts)
+        toret.append(x)
+    return tuple(toret)
+
+def read_slices(comm, sources, dtype):
+    """
+    Read this rank's slice of each of the binary `sources`
+
+    Returns
+    -------
+    data : array_like
+        the concatenated slices
+    slices : list
+        the `(start, stop, N)` of the slice of each source
+    """
+    data, slices = [], []
+    for filename in sources:
+        x = open_binary(filename, dtype)
+        start, stop = rank_slice(len(x), comm)
+        data.append(np.array(x[start:stop]))
+        slices.append((start, stop, len(x)))
+    return np.concatenate(data), slices
+
+def parallel_write(comm, filename, data, start, N):
+    """
+    Collectively write the slice `[start, start+len(data))` of a binary 
+    file holding `N` items, using MPI-IO
+    """
+    from mpi4py import MPI
+
+    data = np.ascontiguousarray(data)
+    fh = MPI.File.Open(comm, filename, MPI.MODE_WRONLY|MPI.MODE_CREATE)
+    try:
+        fh.Set_size(N*data.itemsize)
+        fh.Write_at_all(start*data.itemsize, [data.view('u1'), MPI.BYTE])
+    finally:
+        fh.Close()
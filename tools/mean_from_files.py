@@ -1,18 +1,25 @@
 import argparse as ap
+import os
 import numpy as np
-from glob import glob
+from itertools import izip
 from nbodykit import files, dataset
 from lsskit.specksis import io
 from lsskit import data as lss_data
+from fileio import ParseCache, glob_sources, source_key, source_kind, read_member, read_npz
+from online_stats import DataSetAccumulator
+from profiling import add_profile_arguments, from_args
 
 def average(datasets, weights=None, sum_only=[]):
     """
     Compute the average from a set of `DataSet` objects
     
+    The average is accumulated one `DataSet` at a time, so `datasets`
+    can be any iterable, i.e., a generator that reads each object on demand
+    
     Parameters
     ----------
-    datasets : list
-        a list of `DataSet` instances to average over
+    datasets : iterable
+        an iterable of `DataSet` instances to average over
     weights : array_like, str, optional
         optionally weight by an array or column
     sum_only : list
@@ -23,41 +30,264 @@ def average(datasets, weights=None, sum_only=[]):
     averaged : DataSet
         the DataSet instance holding the mean values
     """
-    # check columns for all objects
-    columns = [d.variables for d in datasets]
-    if not all(sorted(cols) == sorted(columns[0]) for cols in columns):
-        raise ValueError("cannot average DataSet with different column names")
-        
-    # compute the weights
-    if weights is None:
-        weights = np.ones((len(datasets),) + datasets[0].shape)
+    if weights is None or isinstance(weights, basestring):
+        acc = DataSetAccumulator(weights=weights, sum_only=sum_only)
+        for d in datasets:
+            acc.update(d)
     else:
-        if isinstance(weights, basestring):
-            if weights not in columns[0]:
-                raise ValueError("Cannot weight by `%s`; no such column" %weights)
-            weights = np.array([d[weights] for d in datasets])
-    
-    # return a copy
-    toret = datasets[0].copy()
-    
-    # take the mean or the sum   
-    for name in columns[0]:
-        col_data = np.array([d[name] for d in datasets])
-        if name not in sum_only:
-            with np.errstate(invalid='ignore'):
-                toret[name] = (col_data*weights).sum(axis=0) / weights.sum(axis=0)
+        acc = DataSetAccumulator(sum_only=sum_only)
+        for d, w in izip(datasets, weights):
+            acc.update(d, weights=w)
+    return acc.result()
+        
+
+def read_dataset(filename, cls, mode, sum_only=[], cache=None):
+    """
+    Read a single plain text file and return the `DataSet`, optionally
+    using the binary `ParseCache` to avoid parsing the text again
+    
+    The file can also be a binary ``.npz`` result, or a member of a 
+    packed archive, given as ``archive::member``, which are read 
+    without any parsing; the kind of a `Source` returned by `glob_sources`
+    is known, and is not checked again
+    """
+    kind = source_kind(filename)
+    if kind == 'member':
+        try:
+            d, m = read_member(filename)
+        except Exception as e:
+            raise RuntimeError("error reading `%s` from packed archive: %s" %(filename, str(e)))
+        return cls.from_nbkit(d, m, sum_only=sum_only, force_index_match=True)
+    
+    if kind == 'npz':
+        try:
+            d, m = read_npz(filename)
+        except Exception as e:
+            raise RuntimeError("error reading `%s` as npz file: %s" %(filename, str(e)))
+        return cls.from_nbkit(d, m, sum_only=sum_only, force_index_match=True)
+        
+    reader = files.Read2DPlainText if mode == '2d' else files.Read1DPlainText
+    try:
+        if cache is not None:
+            d, m = cache.read(filename, mode, reader)
         else:
-            toret[name] = np.sum(col_data, axis=0)
+            d, m = reader(filename)
+    except Exception as e:
+        raise RuntimeError("error reading `%s` as plain text file: %s" %(filename, str(e)))
+    
+    return cls.from_nbkit(d, m, sum_only=sum_only, force_index_match=True)
+    
+
+def split_files(filenames, N):
+    """
+    Split a list of file names into (at most) `N` contiguous chunks, 
+    preserving the input order
+    """
+    bounds = [i*len(filenames)//N for i in range(N+1)]
+    chunks = [filenames[bounds[i]:bounds[i+1]] for i in range(N)]
+    return [chunk for chunk in chunks if len(chunk)]
+    
+
+def accumulate_files(filenames, cls, mode, targets=None, nacc=1, cache=None, **kws):
+    """
+    Read a list of files one at a time, adding each file to one or more
+    `DataSetAccumulator` objects
+    
+    Parameters
+    ----------
+    filenames : list of str
+        the list of files to read
+    cls : str, DataSet
+        the `DataSet` class, or its name
+    mode : {'1d', '2d'}
+        the mode of the plain text files
+    targets : list, optional
+        for each file, the list of indices of the accumulators to add 
+        the file to; if `None`, all files are added to the first one
+    nacc : int, optional
+        the number of accumulators
+    cache : ParseCache, optional
+        the cache of parsed files to use
+    **kws : 
+        the `weights`, `sum_only` and `stats` keywords passed
+        to `DataSetAccumulator`
+    
+    Returns
+    -------
+    accs : list of DataSetAccumulator
+        the `nacc` accumulators holding the partial sums
+    """
+    if isinstance(cls, basestring):
+        cls = getattr(dataset, cls)
+    if targets is None:
+        targets = [[0]]*len(filenames)
         
-    # handle the metadata
-    for key in datasets[0].attrs:
+    # each file is read only once, no matter how many accumulators need it
+    accs = [DataSetAccumulator(**kws) for i in range(nacc)]
+    for f, target in zip(filenames, targets):
+        d = read_dataset(f, cls, mode, kws.get('sum_only', []), cache)
+        for i in target:
+            accs[i].update(d, filename=source_key(f))
+    return accs
+    
+    
+def _accumulate_files(task):
+    """
+    Unpack the arguments to `accumulate_files`, for use with a process pool
+    """
+    args, kws = task
+    return accumulate_files(*args, **kws)
+    
+
+def parallel_accumulate(filenames, cls, mode, targets=None, nacc=1, 
+                            nprocs=1, comm=None, cache=None, **kws):
+    """
+    Accumulate a list of files, splitting the work across a pool of 
+    processes or across the ranks of an MPI communicator
+    
+    Each worker reduces its share of the files to partial weighted sums, 
+    which are then merged, in order, into the final accumulators
+    
+    Parameters
+    ----------
+    filenames : list of str
+        the list of files to read
+    cls : str
+        the name of the `DataSet` class to use
+    mode : {'1d', '2d'}
+        the mode of the plain text files
+    targets : list, optional
+        for each file, the list of indices of the accumulators to add 
+        the file to; if `None`, all files are added to the first one
+    nacc : int, optional
+        the number of accumulators
+    nprocs : int, optional
+        the number of processes to use, if not using MPI
+    comm : MPI.Communicator, optional
+        if provided, split the files across the ranks of this communicator
+    cache : ParseCache, optional
+        the cache of parsed files to use
+    **kws : 
+        the `weights`, `sum_only` and `stats` keywords passed
+        to `DataSetAccumulator`
+        
+    Returns
+    -------
+    accs : list of DataSetAccumulator
+        the `nacc` merged accumulators; under MPI, these are only returned 
+        on the root rank and `None` is returned elsewhere
+    """
+    if targets is None:
+        targets = [[0]]*len(filenames)
+    tasks = list(zip(filenames, targets))
+    
+    # split across MPI ranks
+    if comm is not None:
+        chunks = split_files(tasks, comm.size)
+        mine = chunks[comm.rank] if comm.rank < len(chunks) else []
+        args = ([f for f, _ in mine], cls, mode, [t for _, t in mine], nacc, cache)
         try:
-            toret.attrs[key] = np.mean([d.attrs[key] for d in datasets])
-        except:
-            pass
-    return toret
+            partial = accumulate_files(*args, **kws)
+        except Exception as e:
+            partial = e
+        partials = comm.gather(partial, root=0)
         
+        # forward the first error to every rank
+        error = None
+        if comm.rank == 0:
+            error = next((p for p in partials if isinstance(p, Exception)), None)
+        error = comm.bcast(error, root=0)
+        if error is not None: raise error
+        if comm.rank != 0:
+            return None
+    
+    # split across a process pool
+    elif nprocs > 1 and len(tasks) > 1:
+        from multiprocessing import Pool
+        
+        chunks = split_files(tasks, nprocs)
+        chunks = [(([f for f, _ in c], cls, mode, [t for _, t in c], nacc, cache), kws) for c in chunks]
+        pool = Pool(len(chunks))
+        try:
+            partials = pool.map(_accumulate_files, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    
+    # just do it serially
+    else:
+        return accumulate_files(filenames, cls, mode, targets, nacc, cache, **kws)
+    
+    # merge the partial sums, in order
+    accs = [DataSetAccumulator(**kws) for i in range(nacc)]
+    for partial in partials:
+        for acc, p in zip(accs, partial):
+            acc.merge(p)
+    return accs
+    
 
+def format_batch(s, batch):
+    """
+    Replace each `%s` in the string `s` with the batch string
+    """
+    fmt_count = s.count('%s')
+    if fmt_count > 0:
+        s = s %((batch,)*fmt_count)
+    return s
+    
+    
+def plan_batches(jobs):
+    """
+    Expand the file pattern of each batch up front, such that each 
+    unique file only needs to be read once
+    
+    Parameters
+    ----------
+    jobs : list of dict
+        the `pattern` and `state` file of each batch
+    
+    Returns
+    -------
+    filenames : list of str
+        the unique files to read, in order of first appearance
+    targets : list
+        for each file, the indices of the batches that need it
+    states : list
+        the `DataSetAccumulator` loaded from the state file of each 
+        batch, or `None`
+    """
+    filenames, targets, states = [], [], []
+    index = {}
+    for i, job in enumerate(jobs):
+        results = glob_sources(job['pattern'])
+        if not len(results):
+            raise RuntimeError("whoops, no files match input pattern `%s`" %job['pattern'])
+            
+        # resume from the saved state, only reading files not yet included
+        state = None
+        if job['state'] is not None and os.path.exists(job['state']):
+            state = DataSetAccumulator.load(job['state'])
+            seen = set(state.filenames)
+            results = [f for f in results if source_key(f) not in seen]
+            print "resuming from %d files in state `%s`..." %(len(state), job['state'])
+        states.append(state)
+        
+        if job['batch'] is not None:
+            print "batch string %s: averaging %d files..." %(job['batch'], len(results))
+        else:
+            print "averaging %d files..." %len(results)
+        
+        for f in results:
+            key = source_key(f)
+            if key not in index:
+                index[key] = len(filenames)
+                filenames.append(f)
+                targets.append([])
+            targets[index[key]].append(i)
+    
+    return filenames, targets, states
+    
+    
 def average_from_files(args):
     """
     Compute the average from a set of files
@@ -65,55 +295,76 @@ def average_from_files(args):
     valid = ['Corr1dDataSet', 'Corr2dDataSet', 'Power1dDataSet', 'Power2dDataSet']
     if not hasattr(dataset, args.cls):
         raise ValueError("`class` must be one of %s" %str(valid))
-    cls = getattr(dataset, args.cls)
-
-    nbatch = 1
-    if args.batch is not None:
-        nbatch = len(args.batch)
     
-    # do each pattern provided
-    for n in range(nbatch):
-        
-        # try to replace with the batch string
-        pattern = args.pattern
-        output_file = args.output
-        if args.batch is not None:
-            print "processing batch string %s..." %args.batch[n]
-            
-            # do the pattern
-            fmt_count = pattern.count('%s')
-            if fmt_count > 0:
-                fmt_strs = (args.batch[n])*fmt_count
-                pattern = pattern %fmt_strs
-                
-            # and the output file
-            fmt_count = output_file.count('%s')
-            if fmt_count > 0:
-                fmt_strs = (args.batch[n])*fmt_count
-                output_file = output_file %fmt_strs
-        
-        # read the files
-        results = glob(pattern)
-        if not len(results):
-            raise RuntimeError("whoops, no files match input pattern `%s`" %pattern)
-        print "averaging %d files..." %len(results)
+    # split the files across MPI ranks
+    comm = None
+    if args.use_mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    root = comm is None or comm.rank == 0
+    profiler = from_args(args, comm=comm)
     
-        # loop over each file
-        data = []
-        reader = files.Read2DPlainText if args.mode == '2d' else files.Read1DPlainText
-        for f in results:
-            try:
-                d, m = reader(f)
-            except Exception as e:
-                raise RuntimeError("error reading `%s` as plain text file: %s" %(f, str(e)))
+    # the cache of parsed files
+    cache = None
+    if not args.no_cache:
+        cache = ParseCache(args.cache_dir, max_size=args.cache_size)
+    
+    # try to replace the input/output/state files with each batch string
+    jobs = []
+    for batch in ([None] if args.batch is None else args.batch):
+        job = {'batch':batch, 'pattern':args.pattern, 'output':args.output, 'state':args.state}
+        if batch is not None:
+            for k in ['pattern', 'output', 'state']:
+                if job[k] is not None: job[k] = format_batch(job[k], batch)
+        jobs.append(job)
+    
+    # read the files (only once under MPI)
+    plan = None
+    if root:
+        try:
+            with profiler.stage('plan'):
+                plan = plan_batches(jobs)
+        except Exception as e:
+            if comm is None: raise
+            plan = e
+    if comm is not None:
+        plan = comm.bcast(plan, root=0)
+        if isinstance(plan, Exception): raise plan
+    filenames, targets, states = plan
+    if root: print "reading %d unique files..." %len(filenames)
+    
+    # accumulate every batch at once, possibly in parallel
+    kws = {'weights':args.weights, 'sum_only':args.sum_only, 'stats':args.stats}
+    with profiler.stage('accumulate'):
+        accs = parallel_accumulate(filenames, args.cls, args.mode, targets=targets, nacc=len(jobs), 
+                                    nprocs=args.nprocs, comm=comm, cache=cache, **kws)
+    if not root:
+        profiler.save()
+        return
+    
+    # the other ranks wait in `save`, so reach it even if writing fails
+    try:
+        for job, acc, state in zip(jobs, accs, states):
             
-            d = cls.from_nbkit(d, m, sum_only=args.sum_only, force_index_match=True)
-            data.append(d)
-        
-        
-        # compute the average
-        avg = average(data, sum_only=args.sum_only, weights=args.weights)
-        io.write_plaintext(avg, output_file)
+            # fold in the new files and save the updated state
+            with profiler.stage('state'):
+                if state is not None:
+                    acc = state.merge(acc)
+                if job['state'] is not None:
+                    acc.save(job['state'])
+            
+            # compute the average
+            with profiler.stage('write'):
+                avg = acc.result()
+                io.write_plaintext(avg, job['output'])
+            
+            # and the statistics across realizations
+            if len(args.stats):
+                with profiler.stage('stats'):
+                    stats_file = os.path.splitext(job['output'])[0] + '.stats.npz'
+                    np.savez(stats_file, **acc.statistics())
+    finally:
+        profiler.save(nfiles=len(filenames), nbatches=len(jobs))
     
 if __name__ == '__main__':
     
@@ -124,7 +375,8 @@ if __name__ == '__main__':
                             
     h = 'the mode, either 1D or 2D'
     parser.add_argument('mode', choices=['1d', '2d'], help=h)
-    h = 'the pattern to match files power files on'
+    h = 'the pattern to match files power files on, or a packed archive written ' + \
+        'by `pack_files.py`, optionally followed by `::` and a pattern of member names'
     parser.add_argument('pattern', type=str, help=h)
     h = 'the name of the output file'
     parser.add_argument('output', default=None, type=str, help=h)
@@ -141,5 +393,30 @@ if __name__ == '__main__':
     h = 'the name of the class instance to use'
     parser.add_argument('--class', dest='cls', type=str, default='Power2dDataSet', help=h)
 
+    h = 'compute the mean, variance, covariance and jackknife errors across ' + \
+        'realizations of these columns, saved to `<output>.stats.npz`'
+    parser.add_argument('--stats', nargs='*', default=[], help=h)
+
+    h = 'the name of a file holding the running sums, which is updated with any ' + \
+        'files not yet included; use %%s format with --batch'
+    parser.add_argument('--state', type=str, help=h)
+    
+    h = 'the number of processes to use when reading files'
+    parser.add_argument('--nprocs', type=int, default=1, help=h)
+    
+    h = 'split the files across the ranks of MPI.COMM_WORLD'
+    parser.add_argument('--use_mpi', action='store_true', help=h)
+    
+    h = 'the directory holding the binary cache of parsed files'
+    parser.add_argument('--cache_dir', type=str, default=os.path.expanduser('~/.cache/nbkit_addons'), help=h)
+    
+    h = 'the maximum size of the binary cache in MB'
+    parser.add_argument('--cache_size', type=float, default=1024., help=h)
+    
+    h = 'do not use the binary cache of parsed files'
+    parser.add_argument('--no_cache', action='store_true', help=h)
+    
+    add_profile_arguments(parser)
+
     # run
     average_from_files(parser.parse_args())
\ No newline at end of file
@@ -0,0 +1,354 @@
+"""
+Numerically stable, single-pass statistics over a set of realizations,
+and running weighted means of `DataSet` objects
+"""
+import cPickle
+import numpy as np
+from fileio import atomic_write
+
+class OnlineMoments(object):
+    """
+    The running mean and co-moment matrix of an array-valued quantity,
+    updated one realization at a time
+
+    Updates use Welford's algorithm and partial results are combined with
+    the pairwise update of Chan et al., so that the statistics never
+    require holding more than a single realization in memory
+
+    Parameters
+    ----------
+    covariance : bool, optional
+        if `True`, track the full co-moment matrix; otherwise, only
+        track its diagonal, i.e., the variance
+    """
+    def __init__(self, covariance=True):
+        self.covariance = covariance
+        self.size = 0
+        self.shape = None
+        self.mean = None
+        self.M2 = None
+
+    def __len__(self):
+        return self.size
+
+    def update(self, x):
+        """
+        Add a single realization `x` to the running moments
+        """
+        x = np.asarray(x)
+        if self.size == 0:
+            self.shape = x.shape
+            self.mean = np.array(x.ravel(), dtype=np.result_type(x, 1.))
+            if self.covariance:
+                self.M2 = np.zeros((x.size, x.size), dtype=self.mean.dtype)
+            else:
+                self.M2 = np.zeros(x.size, dtype=self.mean.dtype)
+            self.size = 1
+            return
+
+        if x.shape != self.shape:
+            raise ValueError("shape mismatch: expected %s, got %s" %(str(self.shape), str(x.shape)))
+
+        x = x.ravel()
+        self.size += 1
+        delta = x - self.mean
+        self.mean += delta / self.size
+        delta2 = np.conj(x - self.mean)
+        if self.covariance:
+            self.M2 += np.outer(delta, delta2)
+        else:
+            self.M2 += delta * delta2
+
+    def merge(self, other):
+        """
+        Combine the moments of `other` with this object
+        """
+        if other.size == 0:
+            return self
+        if self.size == 0:
+            self.covariance = other.covariance
+            self.size = other.size
+            self.shape = other.shape
+            self.mean = other.mean.copy()
+            self.M2 = other.M2.copy()
+            return self
+
+        if other.shape != self.shape or other.covariance != self.covariance:
+            raise ValueError("cannot merge moments with different shapes")
+
+        N = self.size + other.size
+        delta = other.mean - self.mean
+        self.mean += delta * (1. * other.size / N)
+        f = 1. * self.size * other.size / N
+        if self.covariance:
+            self.M2 += other.M2 + np.outer(delta, np.conj(delta)) * f
+        else:
+            self.M2 += other.M2 + delta * np.conj(delta) * f
+        self.size = N
+        return self
+
+    def _normed(self, norm):
+        if self.size < 2:
+            return np.nan * np.ones_like(self.M2)
+        return self.M2 / norm
+
+    @property
+    def variance(self):
+        """
+        The sample variance, with the same shape as a single realization
+        """
+        M2 = np.diag(self.M2) if self.covariance else self.M2
+        if self.size < 2:
+            toret = np.nan * np.ones(M2.shape)
+        else:
+            toret = M2.real / (self.size - 1.)
+        return toret.reshape(self.shape)
+
+    @property
+    def covariance_matrix(self):
+        """
+        The sample covariance matrix of the flattened realizations
+        """
+        if not self.covariance:
+            raise ValueError("full covariance was not tracked")
+        return self._normed(self.size - 1.)
+
+    @property
+    def jackknife_variance(self):
+        """
+        The leave-one-out jackknife variance of the mean, with the same
+        shape as a single realization
+
+        For the delete-one means, ``(N*mean - x_i) / (N-1)``, the jackknife
+        estimate reduces exactly to ``M2 / (N*(N-1))``
+        """
+        return self.variance / self.size
+
+    @property
+    def jackknife_covariance(self):
+        """
+        The leave-one-out jackknife covariance matrix of the mean
+        """
+        if not self.covariance:
+            raise ValueError("full covariance was not tracked")
+        return self._normed(self.size * (self.size - 1.))
+
+    def to_dict(self, prefix=''):
+        """
+        Return a dictionary of the statistics, i.e., for use with
+        `numpy.savez`, with keys optionally prefixed by `prefix`
+        """
+        toret = {}
+        toret[prefix+'mean'] = self.mean.reshape(self.shape)
+        toret[prefix+'variance'] = self.variance
+        toret[prefix+'jackknife_variance'] = self.jackknife_variance
+        if self.covariance:
+            toret[prefix+'covariance'] = self.covariance_matrix
+            toret[prefix+'jackknife_covariance'] = self.jackknife_covariance
+        toret[prefix+'size'] = self.size
+        return toret
+
+
+class DataSetAccumulator(object):
+    """
+    Accumulate running weighted sums over a stream of `DataSet` objects,
+    so that only a single `DataSet` needs to be held in memory at once
+
+    Parameters
+    ----------
+    weights : str, optional
+        the name of the column to weight by; if `None`, use uniform weights
+    sum_only : list
+        fields which should be summed over, not averaged
+    stats : list, optional
+        fields for which to also compute the (unweighted) mean, variance, 
+        covariance and jackknife statistics across realizations
+    """
+    def __init__(self, weights=None, sum_only=[], stats=[]):
+        self.weights = weights
+        self.sum_only = list(sum_only)
+        self.stats = list(stats)
+        self.moments = dict((name, OnlineMoments()) for name in self.stats)
+
+        self.size = 0
+        self.filenames = []
+        self.template = None
+        self.columns = None
+        self.sums = {}
+        self.weight_sum = None
+        self.attr_sums = {}
+
+    def __len__(self):
+        return self.size
+
+    def update(self, d, weights=None, filename=None):
+        """
+        Add a single `DataSet` to the running sums
+
+        Parameters
+        ----------
+        d : DataSet
+            the `DataSet` instance to add
+        weights : array_like, optional
+            the weights to use for this `DataSet`, which take precedence
+            over the `weights` column given on initialization
+        filename : str, optional
+            the name of the file `d` was read from, which is recorded
+            in the `filenames` list
+        """
+        # check columns against the first object
+        if self.template is not None and sorted(d.variables) != self.columns:
+            raise ValueError("cannot average DataSet with different column names")
+
+        # compute the weights
+        if weights is None:
+            if self.weights is None:
+                weights = np.ones(d.shape)
+            else:
+                if self.weights not in d.variables:
+                    raise ValueError("Cannot weight by `%s`; no such column" %self.weights)
+                weights = d[self.weights]
+
+        # update the statistics across realizations
+        for name in self.stats:
+            if name not in d.variables:
+                raise ValueError("Cannot compute statistics of `%s`; no such column" %name)
+            self.moments[name].update(d[name])
+
+        # first object sets the template and the column names
+        if self.template is None:
+            self.template = d.copy()
+            self.columns = sorted(d.variables)
+            self.weight_sum = np.array(weights, copy=True)
+            for name in self.columns:
+                if name not in self.sum_only:
+                    self.sums[name] = d[name]*weights
+                else:
+                    self.sums[name] = np.array(d[name], copy=True)
+            for key in d.attrs:
+                try:
+                    self.attr_sums[key] = np.add(0., d.attrs[key])
+                except:
+                    pass
+            self.size = 1
+            if filename is not None: self.filenames.append(filename)
+            return
+
+        # update the running sums
+        self.weight_sum += weights
+        for name in self.columns:
+            if name not in self.sum_only:
+                self.sums[name] += d[name]*weights
+            else:
+                self.sums[name] += d[name]
+
+        # attributes that cannot be averaged keep the value of the first object
+        for key in list(self.attr_sums):
+            try:
+                self.attr_sums[key] = np.add(self.attr_sums[key], d.attrs[key])
+            except:
+                self.attr_sums.pop(key)
+        self.size += 1
+        if filename is not None: self.filenames.append(filename)
+
+    def merge(self, other):
+        """
+        Merge the running sums of another accumulator into this one, as
+        if the objects added to `other` were added after those of `self`
+
+        Parameters
+        ----------
+        other : DataSetAccumulator
+            the accumulator holding the partial sums to merge
+        """
+        if self.weights != other.weights or sorted(self.sum_only) != sorted(other.sum_only) \
+            or sorted(self.stats) != sorted(other.stats):
+            raise ValueError("cannot merge accumulators with different `weights`, `sum_only` or `stats`")
+
+        # nothing to do
+        if other.template is None:
+            return self
+
+        # take the state of other
+        if self.template is None:
+            self.template = other.template.copy()
+            self.columns = list(other.columns)
+            self.weight_sum = other.weight_sum.copy()
+            self.sums = dict((name, other.sums[name].copy()) for name in other.sums)
+            self.attr_sums = dict(other.attr_sums)
+            self.size = other.size
+            self.filenames = list(other.filenames)
+            self.moments = dict((name, OnlineMoments().merge(other.moments[name])) for name in self.stats)
+            return self
+
+        if other.columns != self.columns:
+            raise ValueError("cannot average DataSet with different column names")
+
+        self.weight_sum += other.weight_sum
+        for name in self.columns:
+            self.sums[name] += other.sums[name]
+        for key in list(self.attr_sums):
+            if key in other.attr_sums:
+                self.attr_sums[key] = np.add(self.attr_sums[key], other.attr_sums[key])
+            else:
+                self.attr_sums.pop(key)
+        self.size += other.size
+        self.filenames += other.filenames
+        for name in self.stats:
+            self.moments[name].merge(other.moments[name])
+        return self
+
+    def save(self, filename):
+        """
+        Save the state of the accumulator to a pickle file, such that 
+        the running sums can be resumed with `load`
+        """
+        with atomic_write(filename) as ff:
+            cPickle.dump(self, ff, protocol=cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the state of an accumulator previously saved with `save`
+        """
+        with open(filename, 'rb') as ff:
+            toret = cPickle.load(ff)
+        if not isinstance(toret, cls):
+            raise ValueError("`%s` does not hold the state of a `%s`" %(filename, cls.__name__))
+        return toret
+
+    def result(self):
+        """
+        Return the `DataSet` holding the mean (or summed) values
+        """
+        if self.template is None:
+            raise ValueError("cannot compute the average of zero DataSet objects")
+
+        # return a copy
+        toret = self.template.copy()
+
+        # take the mean or the sum
+        for name in self.columns:
+            if name not in self.sum_only:
+                with np.errstate(invalid='ignore'):
+                    toret[name] = self.sums[name] / self.weight_sum
+            else:
+                toret[name] = self.sums[name].copy()
+
+        # handle the metadata
+        for key in self.attr_sums:
+            toret.attrs[key] = np.mean(self.attr_sums[key]) / self.size
+        return toret
+
+    def statistics(self):
+        """
+        Return a dictionary holding the mean, variance, covariance and
+        jackknife statistics across realizations of each of the `stats`
+        fields, with keys prefixed by the field name
+
+        The covariance matrices are computed for the flattened fields
+        """
+        toret = {}
+        for name in self.stats:
+            toret.update(self.moments[name].to_dict(prefix=name+'_'))
+        return toret
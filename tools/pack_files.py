@@ -0,0 +1,46 @@
+import argparse as ap
+from glob import glob
+from nbodykit import files
+from fileio import write_packed
+
+def iter_files(filenames, mode):
+    """
+    Parse each plain text file in turn, yielding `(name, data, metadata)`
+    """
+    reader = files.Read2DPlainText if mode == '2d' else files.Read1DPlainText
+    for f in filenames:
+        try:
+            d, m = reader(f)
+        except Exception as e:
+            raise RuntimeError("error reading `%s` as plain text file: %s" %(f, str(e)))
+        yield f, d, m
+        
+def pack_files(args):
+    """
+    Pack the files matching the input pattern into a single archive
+    """
+    results = sorted(glob(args.pattern))
+    if not len(results):
+        raise RuntimeError("whoops, no files match input pattern `%s`" %args.pattern)
+    print "packing %d files..." %len(results)
+    
+    N = write_packed(args.output, iter_files(results, args.mode))
+    print "...wrote %d members to `%s`" %(N, args.output)
+    
+if __name__ == '__main__':
+    
+    desc = "pack a set of 1D or 2D plain text files into a single, indexed " + \
+           "binary archive, which can be memory mapped and used as the input " + \
+           "pattern of `mean_from_files.py`"
+    parser = ap.ArgumentParser(description=desc, 
+                                formatter_class=ap.ArgumentDefaultsHelpFormatter)
+                            
+    h = 'the mode, either 1D or 2D'
+    parser.add_argument('mode', choices=['1d', '2d'], help=h)
+    h = 'the pattern to match files power files on'
+    parser.add_argument('pattern', type=str, help=h)
+    h = 'the name of the output archive'
+    parser.add_argument('output', type=str, help=h)
+
+    # run
+    pack_files(parser.parse_args())
@@ -0,0 +1,188 @@
+"""
+Instrumentation shared by the tools: nestable timers for named stages,
+optional cProfile and tracemalloc capture, and the aggregation of the
+results of each MPI rank, written to a single JSON file
+"""
+import json
+import platform
+import resource
+import sys
+import time
+import warnings
+from contextlib import contextmanager
+import numpy as np
+
+def peak_rss():
+    """
+    The peak resident set size of this process, in MB
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024.**2 if sys.platform == 'darwin' else usage / 1024.
+
+def summarize(reports):
+    """
+    The minimum, median and maximum across ranks of the time spent in
+    each stage, the wall time and the peak RSS
+    
+    Parameters
+    ----------
+    reports : list of dict
+        the `Profiler.report` of each rank
+    """
+    def stats(values):
+        values = np.array(values, dtype='f8')
+        return {'min':values.min(), 'median':np.median(values), 'max':values.max()}
+    
+    toret = {'wall_time':stats([r['wall_time'] for r in reports]),
+             'peak_rss':stats([r['peak_rss'] for r in reports]), 'stages':{}}
+    
+    paths = sorted(set(path for r in reports for path in r['stages']))
+    for path in paths:
+        entries = [r['stages'][path] for r in reports if path in r['stages']]
+        toret['stages'][path] = stats([e['time'] for e in entries])
+        toret['stages'][path]['calls'] = sum(e['calls'] for e in entries)
+        toret['stages'][path]['nranks'] = len(entries)
+    return toret
+
+
+class Profiler(object):
+    """
+    Record the time spent in named, nestable stages of a tool
+    
+    Stages are entered with the `stage` context manager; nested stages
+    are recorded by their path, i.e., ``outer/inner``, and repeated stages
+    accumulate their time and number of calls. If no output file is given,
+    the profiler is disabled, and stages cost next to nothing
+    
+    Parameters
+    ----------
+    filename : str, optional
+        the JSON file to write the results to with `save`
+    cprofile : bool, optional
+        if `True`, also record the functions taking the most time with
+        `cProfile`
+    tracemalloc : bool, optional
+        if `True`, also record the peak traced memory and the largest
+        allocations with `tracemalloc`, when available
+    comm : MPI communicator, optional
+        if provided, `save` gathers the results of all ranks to the root
+    top : int, optional
+        the number of functions (or allocations) to record
+    """
+    def __init__(self, filename=None, cprofile=False, tracemalloc=False, comm=None, top=30):
+        self.filename = filename
+        self.comm = comm
+        self.top = top
+        self.stages = {}
+        self._stack = []
+        self._start = time.time()
+        
+        self._cprofile = None
+        self._tracemalloc = None
+        if not self.enabled:
+            return
+        
+        if cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        
+        if tracemalloc:
+            try:
+                import tracemalloc as tm
+            except ImportError:
+                warnings.warn("tracemalloc is not available; only the peak RSS is recorded")
+            else:
+                if not tm.is_tracing(): tm.start()
+                self._tracemalloc = tm
+    
+    @property
+    def enabled(self):
+        return self.filename is not None
+    
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as the stage ``name``, nested within
+        any enclosing stages
+        """
+        if not self.enabled:
+            yield
+            return
+        
+        self._stack.append(name)
+        path = '/'.join(self._stack)
+        start = time.time()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(path, {'time':0., 'calls':0})
+            entry['time'] += time.time() - start
+            entry['calls'] += 1
+            self._stack.pop()
+    
+    def report(self):
+        """
+        The results of this rank
+        """
+        toret = {'rank':self.comm.rank if self.comm is not None else 0, 'host':platform.node(),
+                 'wall_time':time.time() - self._start, 'peak_rss':peak_rss(), 'stages':self.stages}
+        
+        if self._cprofile is not None:
+            import pstats
+            self._cprofile.disable()
+            entries = []
+            for (f, line, func), (cc, nc, tt, ct, callers) in pstats.Stats(self._cprofile).stats.items():
+                entries.append({'function':"%s:%d(%s)" %(f, line, func), 'calls':nc, 'tottime':tt, 'cumtime':ct})
+            toret['cprofile'] = sorted(entries, key=lambda e: -e['cumtime'])[:self.top]
+        
+        if self._tracemalloc is not None:
+            current, peak = self._tracemalloc.get_traced_memory()
+            snapshot = self._tracemalloc.take_snapshot()
+            toret['tracemalloc'] = {'current':current / 1024.**2, 'peak':peak / 1024.**2,
+                                    'top':[str(s) for s in snapshot.statistics('lineno')[:self.top]]}
+        return toret
+    
+    def save(self, **extra):
+        """
+        Gather the results of all ranks and write them, with a summary
+        across ranks and any ``extra`` items, to the output file
+        
+        Under MPI, this must be called on all ranks
+        """
+        if not self.enabled:
+            return
+        
+        report = self.report()
+        reports = self.comm.gather(report, root=0) if self.comm is not None else [report]
+        if self.comm is not None and self.comm.rank != 0:
+            return
+        
+        toret = {'argv':sys.argv, 'nranks':len(reports), 'summary':summarize(reports), 'ranks':reports}
+        toret.update(extra)
+        with open(self.filename, 'w') as ff:
+            json.dump(toret, ff, indent=2, default=float)
+
+
+def add_profile_arguments(parser, help=None):
+    """
+    Add the ``--profile`` options to the argument ``parser``
+    """
+    h = "write the time spent in each stage, and the peak memory of each rank, to this JSON file"
+    parser.add_argument('--profile', type=str, help=help if help is not None else h)
+    
+    h = "when profiling, also record the functions taking the most time with cProfile"
+    parser.add_argument('--profile_cprofile', action='store_true', help=h)
+    
+    h = "when profiling, also record the largest allocations with tracemalloc, if available"
+    parser.add_argument('--profile_tracemalloc', action='store_true', help=h)
+
+def from_args(args, comm=None, filename=None):
+    """
+    Return the `Profiler` configured by the ``--profile`` options in
+    ``args``, optionally writing to ``filename`` instead
+    """
+    if filename is None:
+        filename = getattr(args, 'profile', None)
+    return Profiler(filename, cprofile=getattr(args, 'profile_cprofile', False),
+                    tracemalloc=getattr(args, 'profile_tracemalloc', False), comm=comm)
@@ -1,13 +1,31 @@
-from nbodykit.extensionpoints import Transfer
+from nbodykit.extensionpoints import Transfer, Algorithm, DataSource, Painter
+import logging
+
+def moment_kernel(ell, ell_prime):
+    """
+    The constant weighting the cross power of the radial momentum
+    moments ``ell`` and ``ell_prime``
+    """
+    from math import factorial
+    
+    norm = factorial(ell) * factorial(ell_prime)
+    if ell == ell_prime:
+        return 1.0 / norm
+    
+    # real part of the sign of i**(ell+ell_prime), with i**n = +/- i taken as +/- 1
+    sign = (-1)**ell_prime * (1 if (ell+ell_prime) % 4 in (0, 1) else -1)
+    return sign * (2. / norm)
 
 class MomentumMomentsAuto(Transfer):
     """
     Transfer function for radial momentum moments
     """
     plugin_name = "MomentumMomentsAuto"
+    elementwise = True
     
     def __init__(self, ell):
-        pass
+        from math import factorial
+        self.kern = 1.0 / factorial(ell)
 
     @classmethod
     def register(cls):
@@ -15,19 +33,17 @@ class MomentumMomentsAuto(Transfer):
         s.add_argument("ell", type=int, help="the radial velocity moment")
   
     def __call__(self, pm, complex):
-        import numpy
-        
-        kern = 1.0 / numpy.math.factorial(self.ell)    
-        complex[:] *= kern
+        complex[:] *= self.kern
         
 class MomentumMomentsCross(Transfer):
     """
     Transfer function for radial momentum moments
     """
     plugin_name = "MomentumMomentsCross"
+    elementwise = True
     
     def __init__(self, ell, ell_prime):
-        pass
+        self.kern = moment_kernel(ell, ell_prime)
 
     @classmethod
     def register(cls):
@@ -36,20 +52,207 @@ class MomentumMomentsCross(Transfer):
         s.add_argument("ell_prime", type=int, help="the 2nd radial velocity moment")
   
     def __call__(self, pm, complex):
+        complex[:] *= self.kern
+
+class BlockMesh(object):
+    """
+    A view of a ParticleMesh restricted to a block of the first axis of 
+    the complex mesh, such that k-dependent transfers see the wavenumbers
+    of the block only
+    """
+    def __init__(self, pm, index, N):
+        self._pm = pm
+        self._index = index
+        self._N = N
+        
+    def __getattr__(self, name):
         import numpy
         
-        norm = numpy.math.factorial(self.ell) * numpy.math.factorial(self.ell_prime)
-        if self.ell == self.ell_prime:
-            kern = 1.0 / norm
-        else:
-            sign = (-1)**self.ell_prime * numpy.sign((1j)**(self.ell+self.ell_prime)).real
-            kern = sign * (2. / norm)
-            
-        complex[:] *= kern
+        val = getattr(self._pm, name)
+        if name in ['k', 'w'] and isinstance(val, (list, tuple)):
+            val = [v[self._index] if numpy.ndim(v) and numpy.shape(v)[0] == self._N else v for v in val]
+        return val
+
+class FusedTransfer(Transfer):
+    """
+    A chain of transfer functions, applied in a single in-place sweep 
+    over the complex mesh
+    
+    Consecutive transfers declaring ``elementwise = True``, i.e., those
+    that update each element from its own value and wavenumber only, with
+    no communication, are fused: the mesh is processed in blocks of its
+    first axis, applying each transfer in turn to a block while it is still
+    in cache, rather than making a full pass over the mesh for each transfer.
+    Any other transfer, i.e., ``NormalizeDC`` or ``RemoveDC``, is applied
+    to the whole mesh at its place in the chain, so the result is identical
+    to applying the transfers one at a time
+    """
+    plugin_name = "FusedTransfer"
+    
+    def __init__(self, transfers, blocksize=None):
+        self.transfers = transfers
+        self.blocksize = blocksize
+        
+    @classmethod
+    def register(cls):
+        s = cls.schema
+        s.add_argument("transfers", type=Transfer.from_config, nargs='+', 
+            help="the transfer functions to apply, in order")
+        s.add_argument("blocksize", type=int, 
+            help="the number of planes of the first axis per block; default is ~1 MB blocks")
         
+    def __call__(self, pm, complex):
+        fused = []
+        for t in self.transfers:
+            if getattr(t, 'elementwise', False):
+                fused.append(t)
+            else:
+                self.sweep(pm, complex, fused)
+                fused = []
+                t(pm, complex)
+        self.sweep(pm, complex, fused)
         
+    def sweep(self, pm, complex, transfers):
+        """
+        Apply the element-wise ``transfers`` in a single blocked sweep
+        """
+        N = complex.shape[0]
+        if not N or not len(transfers):
+            return
+        blocksize = self.blocksize
+        if blocksize is None:
+            blocksize = max(1, 2**20 // max(complex[0].nbytes, 1))
             
+        for start in range(0, N, blocksize):
+            index = slice(start, min(start+blocksize, N))
+            block = complex[index]
+            bpm = BlockMesh(pm, index, N)
+            for t in transfers:
+                t(bpm, block)
 
-
+class MomentumMomentsPower(Algorithm):
+    """
+    The power spectra of all pairs of radial momentum moments up to
+    ``ell_max``, computed from a single paint and FFT of each moment field
+    
+    Each moment field is painted and Fourier transformed once, and all
+    of the auto and cross spectra are computed from the stored complex
+    meshes, weighted by the kernels of `MomentumMomentsAuto` and
+    `MomentumMomentsCross`. This requires memory for ``ell_max+1``
+    complex meshes
+    """
+    plugin_name = "MomentumMomentsPower"
+    logger = logging.getLogger(plugin_name)
+    
+    def __init__(self, mode, Nmesh, data, ell_max, transfer=[], los='z', Nmu=5,
+                    dk=None, kmin=0., poles=[], paintbrush='cic'):
+        pass
+    
+    @classmethod
+    def register(cls):
+        s = cls.schema
+        s.description = "power spectra of all pairs of radial momentum moments via FFT"
         
-            
+        s.add_argument("mode", type=str, choices=["2d", "1d"],
+            help='compute the power as a function of `k` or `k` and `mu`')
+        s.add_argument("Nmesh", type=int, help='the number of cells in the gridded mesh')
+        s.add_argument("data", type=DataSource.from_config,
+            help='the DataSource holding the positions and velocities')
+        s.add_argument("ell_max", type=int, help='the maximum radial velocity moment')
+        s.add_argument("transfer", type=Transfer.from_config, nargs='*',
+            help='the transfer functions to apply to each moment field')
+        s.add_argument("los", type=str, choices="xyz",
+            help="the line-of-sight direction, which is also the velocity component")
+        s.add_argument("Nmu", type=int,
+            help='the number of mu bins to use from mu=[0,1]; if `mode = 1d`, then `Nmu` is set to 1')
+        s.add_argument("dk", type=float,
+            help='the spacing of k bins to use; if not provided, the fundamental mode of the box is used')
+        s.add_argument("kmin", type=float, help='the edge of the first `k` bin to use; default is 0')
+        s.add_argument('poles', nargs='*', type=int,
+            help='if specified, also compute these multipoles from P(k,mu)')
+        s.add_argument('paintbrush', type=lambda x: x.lower(), choices=['cic', 'tsc'],
+            help='the density assignment kernel to use when painting')
+    
+    def pairs(self):
+        """
+        The ``(ell, ell_prime)`` pairs, with ``ell <= ell_prime``
+        """
+        return [(ell, ell_prime) for ell in range(self.ell_max+1) for ell_prime in range(ell, self.ell_max+1)]
+    
+    def run(self):
+        """
+        Paint and FFT each moment field once, and compute the power
+        of every ``(ell, ell_prime)`` pair
+        """
+        import numpy
+        from nbodykit import measurestats
+        from pmesh.particlemesh import ParticleMesh
+        
+        # setup the particle mesh object
+        pm = ParticleMesh(self.data.BoxSize, self.Nmesh, paintbrush=self.paintbrush, dtype='f4', comm=self.comm)
+        
+        # only need one mu bin if 1d case is requested
+        if self.mode == "1d": self.Nmu = 1
+        
+        # paint and FFT each moment field once; the transfers are applied in
+        # order, fusing only those that are element-wise
+        meshes = []; stats = []
+        transfer = FusedTransfer(self.transfer) if len(self.transfer) else None
+        for ell in range(self.ell_max+1):
+            painter = Painter.create('MomentumPainter', velocity_component=self.los, moment=ell)
+            stats.append(painter.paint(pm, self.data))
+            pm.r2c()
+            if transfer is not None:
+                transfer(pm, pm.complex)
+            meshes.append(pm.complex.copy())
+            if self.comm.rank == 0:
+                self.logger.info("painted and transformed moment %d of %d" %(ell, self.ell_max))
+        
+        # binning in k out to the minimum nyquist frequency
+        dk = 2*numpy.pi/pm.BoxSize.min() if self.dk is None else self.dk
+        kedges = numpy.arange(self.kmin, numpy.pi*pm.Nmesh/pm.BoxSize.min() + dk/2, dk)
+        muedges = numpy.linspace(0, 1, self.Nmu+1, endpoint=True)
+        edges = [kedges, muedges]
+        
+        # all of the auto and cross spectra from the stored meshes
+        results = {}
+        for ell, ell_prime in self.pairs():
+            y3d = meshes[ell] * numpy.conj(meshes[ell_prime])
+            y3d *= moment_kernel(ell, ell_prime) * pm.BoxSize.prod()
+            results[(ell, ell_prime)] = measurestats.project_to_basis(pm.comm, pm.k, y3d, edges,
+                                                poles=self.poles, los=self.los, symmetry_axis=-1)
+        
+        # the metadata
+        Lx, Ly, Lz = pm.BoxSize
+        meta = {'Lx':Lx, 'Ly':Ly, 'Lz':Lz, 'volume':Lx*Ly*Lz, 'N1':stats[0]['Ntot']}
+        return edges, results, meta
+    
+    def save(self, output, result):
+        """
+        Save the power of each pair to ``output``, which must contain
+        the ``ell`` and ``ell_prime`` format keywords
+        """
+        import numpy
+        from nbodykit.storage import MeasurementStorage
+        
+        # only the master rank writes
+        if self.comm.rank == 0:
+            edges, results, meta = result
+            for (ell, ell_prime), (res, pole_res) in sorted(results.items()):
+                filename = output.format(ell=ell, ell_prime=ell_prime)
+                if self.mode == "1d":
+                    cols = ['k', 'power', 'modes']
+                    res = [numpy.squeeze(res[i]) for i in [0, 2, 3]]
+                    edges_ = edges[0]
+                else:
+                    cols = ['k', 'mu', 'power', 'modes']
+                    edges_ = edges
+                storage = MeasurementStorage.create(self.mode, filename)
+                storage.write(edges_, cols, res, ell=ell, ell_prime=ell_prime, **meta)
+                
+                # write the multipoles too
+                if len(self.poles):
+                    k, poles, N = pole_res
+                    cols = ['k'] + ['power_%d' %l for l in self.poles] + ['modes']
+                    storage = MeasurementStorage.create('1d', filename.replace('.dat', '_poles.dat'))
+                    storage.write(edges[0], cols, [k] + list(poles) + [N], ell=ell, ell_prime=ell_prime, **meta)